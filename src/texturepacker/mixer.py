@@ -10,8 +10,24 @@ import sys
 import os
 import weakref
 import re
-from zipfile import ZipFile, ZIP_DEFLATED
+import time
+import zlib
+import threading
+import itertools
+import httplib
+import tempfile
+import struct
+import stat
+import errno
+import socket
+import zipfile
+import hashlib
+import marshal
+from multiprocessing import Pool
+from multiprocessing.pool import ThreadPool
+from zipfile import ZipFile, ZipInfo, ZIP_DEFLATED, ZIP_STORED, ZIP64_LIMIT
 from StringIO import StringIO
+from collections import OrderedDict, deque
 from base64 import b64decode
 from datetime import datetime
 import Image
@@ -19,29 +35,22 @@ import httplib2
 import fnmatch
 import json
 import yaml
-from urlparse import urljoin
+from urlparse import urljoin, urlsplit
 import unwrapper
 
-_http = None
 _cache = None
 def set_http_cache(cache):
     """Future HTTP requests will use this cache.
 
+    This applies to every HttpClient not given
+    a cache of its own, including ones already made.
+
     Arguments --
         cache -- either the name of a directory to store files
             in, or an httplib2 cache object
     """
     global _cache
-    if _cache != cache:
-        _cache = cache
-        _http = None
-
-def _get_http():
-    """Helper function to get the HTTP object."""
-    global _http
-    if _http is None:
-        _http = httplib2.Http(_cache)
-    return _http
+    _cache = cache
 
 
 MINECRAFT_DIR_PATH_FUNCS = {
@@ -79,6 +88,41 @@ def url_from_file_path(file_path):
         url += '/'
     return url
 
+def replace_file(temp_path, file_path):
+    """Move the file at temp_path to file_path, replacing any file already there.
+
+    Other processes may be doing the same at the same time (for example,
+    maketexture --jobs sharing a cache directory). Whichever rename comes
+    last wins, and losing the race is not an error.
+    Other errors (such as temp_path having vanished) are raised
+    without touching file_path.
+    """
+    try:
+        os.rename(temp_path, file_path)
+        return
+    except OSError, e:
+        if not _is_replace_refused(e):
+            raise
+    # Windows will not rename over an existing file.
+    try:
+        os.remove(file_path)
+    except OSError:
+        pass # Removed by another process just now.
+    try:
+        os.rename(temp_path, file_path)
+    except OSError, e:
+        if not _is_replace_refused(e):
+            raise
+        # Another process has put its file there first; it will do.
+        try:
+            os.remove(temp_path)
+        except OSError:
+            pass
+
+def _is_replace_refused(e):
+    """Whether this error from os.rename means the destination is in the way."""
+    return e.errno == errno.EEXIST or os.name == 'nt' and e.errno == errno.EACCES
+
 
 GENERIC_RE = re.compile(r"""
     ^
@@ -164,13 +208,602 @@ class DudeItsADirectory(Exception):
         self.path = path
         super(DudeItsADirectory, self).__init__('{0!r}: is a directory'.format(path))
 
+class HttpClient(object):
+    """Makes HTTP requests on behalf of a Loader.
+
+    Requests are made with an httplib2.Http per thread,
+    so that one client can be shared by concurrent downloads.
+    Streamed downloads (see get_spooled) keep their
+    connections open for reuse by later requests to the same host.
+
+    Every request is logged in `log` as a dict with
+    'url', 'status', 'bytes', 'seconds', and 'cached' members.
+
+    Arguments --
+        cache (optional) -- directory name or httplib2 cache object;
+            if omitted, the one set with set_http_cache is used
+        timeout (optional) -- socket timeout in seconds
+    """
+    def __init__(self, cache=None, timeout=None):
+        self._cache = cache
+        self.timeout = timeout
+        self.log = []
+        self._local = threading.local()
+        self._connections = {}
+        self._lock = threading.Lock()
+
+    @property
+    def cache(self):
+        return _cache if self._cache is None else self._cache
+
+    @property
+    def follow_redirects(self):
+        """Whether request follows redirects (set per thread)."""
+        return getattr(self._local, 'follow_redirects', True)
+
+    @follow_redirects.setter
+    def follow_redirects(self, value):
+        self._local.follow_redirects = value
+
+    def get_http(self):
+        """Return the httplib2.Http for this thread and the current cache."""
+        cache = self.cache
+        http = getattr(self._local, 'http', None)
+        if http is None or self._local.http_cache != cache:
+            http = self._local.http = httplib2.Http(cache, timeout=self.timeout)
+            self._local.http_cache = cache
+        return http
+
+    def request(self, url, method='GET', body=None, headers=None):
+        """Make a request as for httplib2.Http.request.
+
+        Returns --
+            response, body
+        """
+        http = self.get_http()
+        http.follow_redirects = self.follow_redirects
+        started = time.time()
+        response, content = http.request(url, method, body=body, headers=headers)
+        self._record(url, response['status'], len(content), started,
+                getattr(response, 'fromcache', False))
+        return response, content
+
+    def get_spooled(self, url, spool_size, redirects=5):
+        """Download from this HTTP URL to a temporary file.
+
+        The body is streamed in to a SpooledTemporaryFile
+        so that big downloads do not have to fit in memory.
+        The file is deleted when the stream is closed.
+
+        If the cache is a directory name, downloads that have
+        an ETag or Last-Modified header are instead kept in
+        its 'spooled' subdirectory, and are only downloaded again
+        if they have changed. This means separate processes
+        using the same cache share their downloads.
+
+        Returns --
+            meta, strm (as for Loader.get_url_stream)
+        """
+        parts = urlsplit(url)
+        path = (parts.path or '/') + ('?' + parts.query if parts.query else '')
+        cache_path = self._get_spooled_cache_path(url)
+        cached_meta = cache_path and self._get_spooled_cache_meta(cache_path)
+        headers = {}
+        if cached_meta:
+            if 'etag' in cached_meta:
+                headers['If-None-Match'] = cached_meta['etag']
+            if 'last-modified' in cached_meta:
+                headers['If-Modified-Since'] = cached_meta['last-modified']
+        started = time.time()
+        conn, response = self._get_response(parts.scheme, parts.netloc, path, headers)
+        try:
+            if response.status in (301, 302, 303, 307) and redirects:
+                response.read()
+                self._release(parts.scheme, parts.netloc, conn, response)
+                self._record(url, str(response.status), 0, started)
+                location = urljoin(url, response.getheader('location'))
+                return self.get_spooled(location, spool_size, redirects - 1)
+            if response.status == 304 and cached_meta:
+                response.read()
+                self._release(parts.scheme, parts.netloc, conn, response)
+                self._record(url, '304', 0, started, True)
+                return cached_meta, open(cache_path, 'rb')
+            if response.status != 200:
+                raise CouldNotLoad('{0!r}: could not load: status={1}'.format(url, response.status))
+        except:
+            conn.close()
+            raise
+        return self._spool_response(url, conn, response, spool_size, cache_path, started)
+
+    def _spool_response(self, url, conn, response, spool_size, cache_path, started):
+        """Read the body of a 200 response in to a file, as for get_spooled."""
+        parts = urlsplit(url)
+        temp_path = None
+        size = 0
+        try:
+            meta = dict(response.getheaders())
+            meta['status'] = str(response.status)
+            if cache_path and ('etag' in meta or 'last-modified' in meta):
+                fd, temp_path = tempfile.mkstemp(dir=os.path.dirname(cache_path))
+                strm = os.fdopen(fd, 'w+b')
+            else:
+                strm = tempfile.SpooledTemporaryFile(spool_size)
+            while True:
+                chunk = response.read(64 * 1024)
+                if not chunk:
+                    break
+                strm.write(chunk)
+                size += len(chunk)
+        except:
+            conn.close()
+            if temp_path:
+                strm.close()
+                os.remove(temp_path)
+            raise
+        self._release(parts.scheme, parts.netloc, conn, response)
+        self._record(url, str(response.status), size, started)
+        if temp_path:
+            strm.close()
+            self._put_spooled_cache(cache_path, temp_path, meta)
+            return meta, open(cache_path, 'rb')
+        strm.seek(0)
+        return meta, strm
+
+    def open_ranged(self, url, spool_size, tail_size=128 * 1024, redirects=5):
+        """Open this HTTP URL for reading parts of it with Range requests.
+
+        The first request asks for the last tail_size bytes,
+        where ZipFile will look for the central directory.
+        If the server does not support ranges, the whole file
+        is downloaded instead, as for get_spooled; so is a file
+        that is already kept in the cache directory.
+
+        Returns --
+            meta, strm (as for Loader.get_url_stream)
+            where strm may be an HttpRangeFile
+        """
+        cache_path = self._get_spooled_cache_path(url)
+        if cache_path and self._get_spooled_cache_meta(cache_path):
+            return self.get_spooled(url, spool_size, redirects)
+        parts = urlsplit(url)
+        path = (parts.path or '/') + ('?' + parts.query if parts.query else '')
+        started = time.time()
+        conn, response = self._get_response(parts.scheme, parts.netloc, path,
+                {'Range': 'bytes=-{0}'.format(tail_size)})
+        try:
+            if response.status in (301, 302, 303, 307) and redirects:
+                response.read()
+                self._release(parts.scheme, parts.netloc, conn, response)
+                self._record(url, str(response.status), 0, started)
+                location = urljoin(url, response.getheader('location'))
+                return self.open_ranged(location, spool_size, tail_size, redirects - 1)
+            if response.status == 416:
+                # Only an empty file has no last bytes; let ZipFile complain about it.
+                response.read()
+                self._release(parts.scheme, parts.netloc, conn, response)
+                self._record(url, '416', 0, started)
+                return self.get_spooled(url, spool_size, redirects)
+            if response.status == 200:
+                return self._spool_response(url, conn, response, spool_size, cache_path, started)
+            if response.status != 206:
+                raise CouldNotLoad('{0!r}: could not load: status={1}'.format(url, response.status))
+            first, size = _parse_content_range(url, response.getheader('content-range'))
+            meta = dict(response.getheaders())
+            meta['status'] = '206'
+            data = response.read()
+        except:
+            conn.close()
+            raise
+        self._release(parts.scheme, parts.netloc, conn, response)
+        self._record(url, '206', len(data), started)
+        etag = meta.get('etag')
+        if etag and etag.startswith('W/'):
+            etag = None # Weak ETags may not be used in If-Range (RFC 7233).
+        strm = HttpRangeFile(self, url, size, etag or meta.get('last-modified'))
+        strm.add_segment(first, data)
+        return meta, strm
+
+    def get_range(self, url, first, last, if_range=None):
+        """Get bytes first to last (inclusive) of the resource at this HTTP URL.
+
+        Arguments --
+            if_range (optional) -- ETag or Last-Modified value
+                the resource must still have
+
+        Raises --
+            CouldNotLoad -- if the server does not return that range
+                (for example, because the resource has changed)
+        """
+        parts = urlsplit(url)
+        path = (parts.path or '/') + ('?' + parts.query if parts.query else '')
+        headers = {'Range': 'bytes={0}-{1}'.format(first, last)}
+        if if_range:
+            headers['If-Range'] = if_range
+        started = time.time()
+        conn, response = self._get_response(parts.scheme, parts.netloc, path, headers)
+        if response.status != 206:
+            # Probably the whole resource follows; do not read it.
+            conn.close()
+            self._record(url, str(response.status), 0, started)
+            raise CouldNotLoad('{0!r}: could not load bytes {1}-{2}: status={3}'.format(
+                    url, first, last, response.status))
+        try:
+            data = response.read()
+        except:
+            conn.close()
+            raise
+        self._release(parts.scheme, parts.netloc, conn, response)
+        self._record(url, '206', len(data), started)
+        if _parse_content_range(url, response.getheader('content-range'))[0] != first:
+            raise CouldNotLoad('{0!r}: could not load bytes {1}-{2}: status={3}'.format(
+                    url, first, last, response.status))
+        return data
+
+    def _get_spooled_cache_path(self, url):
+        cache = self.cache
+        if not isinstance(cache, basestring):
+            return None
+        dir_path = os.path.join(cache, 'spooled')
+        if not os.path.isdir(dir_path):
+            try:
+                os.makedirs(dir_path)
+            except OSError:
+                pass # Probably made by another process just now.
+        return os.path.join(dir_path, hashlib.sha1(url).hexdigest())
+
+    def _get_spooled_cache_meta(self, cache_path):
+        """Return the headers saved with this cached download, or None."""
+        if not os.path.exists(cache_path):
+            return None
+        try:
+            with open(cache_path + '.json', 'rb') as strm:
+                return json.load(strm)
+        except (IOError, ValueError):
+            return None
+
+    def _put_spooled_cache(self, cache_path, temp_path, meta):
+        try:
+            os.remove(cache_path + '.json') # So the old headers are not paired with the new file.
+        except OSError:
+            pass # Not cached before, or removed by another process.
+        replace_file(temp_path, cache_path)
+        fd, temp_path = tempfile.mkstemp(dir=os.path.dirname(cache_path))
+        with os.fdopen(fd, 'wb') as strm:
+            json.dump(meta, strm)
+        replace_file(temp_path, cache_path + '.json')
+
+    def _get_response(self, scheme, netloc, path, headers={}):
+        """Send a GET, reusing an idle connection to this host if there is one."""
+        with self._lock:
+            idle = self._connections.get((scheme, netloc))
+            conn = idle.pop() if idle else None
+        if conn:
+            try:
+                conn.request('GET', path, headers=headers)
+                return conn, conn.getresponse()
+            except (httplib.HTTPException, socket.error):
+                # The server has closed the connection since we last used it.
+                conn.close()
+        conn_class = httplib.HTTPSConnection if scheme == 'https' else httplib.HTTPConnection
+        conn = conn_class(netloc, timeout=self.timeout)
+        try:
+            conn.request('GET', path, headers=headers)
+            return conn, conn.getresponse()
+        except:
+            conn.close()
+            raise
+
+    def _release(self, scheme, netloc, conn, response):
+        """Keep this connection for the next request to the same host."""
+        if response.will_close:
+            conn.close()
+            return
+        with self._lock:
+            self._connections.setdefault((scheme, netloc), []).append(conn)
+
+    def _record(self, url, status, size, started, cached=False):
+        self.log.append({
+            'url': url,
+            'status': status,
+            'bytes': size,
+            'seconds': time.time() - started,
+            'cached': cached,
+        })
+
+    def close(self):
+        """Close the idle connections."""
+        with self._lock:
+            conns = [conn for idle in self._connections.values() for conn in idle]
+            self._connections = {}
+        for conn in conns:
+            conn.close()
+
+
+CONTENT_RANGE_RE = re.compile(r'bytes (\d+)-\d+/(\d+)$')
+
+def _parse_content_range(url, value):
+    """Return the first byte and total size from a Content-Range header."""
+    m = CONTENT_RANGE_RE.match((value or '').strip())
+    if not m:
+        raise CouldNotLoad('{0!r}: bad Content-Range: {1!r}'.format(url, value))
+    return int(m.group(1)), int(m.group(2))
+
+
+class HttpRangeFile(object):
+    """A read-only file whose contents are fetched with HTTP Range requests.
+
+    This is enough of a file for ZipFile, which only needs
+    to read the central directory and the entries used.
+    Bytes fetched are kept, so they are only requested once.
+
+    Arguments --
+        http -- HttpClient to make the requests
+        url -- HTTP URL of the file
+        size -- its length in bytes
+        validator (optional) -- its ETag or Last-Modified header,
+            so that a change to the file is noticed
+        block_size (optional) -- smallest number of bytes
+            to ask for at a time
+    """
+    def __init__(self, http, url, size, validator=None, block_size=64 * 1024):
+        self.http = http
+        self.name = url
+        self.size = size
+        self.validator = validator
+        self.block_size = block_size
+        self.segments = [] # List of (first, data) pairs.
+        self.pos = 0
+
+    def add_segment(self, first, data):
+        self.segments.append((first, data))
+
+    def fetch(self, start, end):
+        """Make sure bytes start up to (not including) end have been fetched.
+
+        This means the reads that follow need only one request.
+        """
+        end = min(end, self.size)
+        for first, data in self.segments:
+            if first <= start and end <= first + len(data):
+                return data, first
+        last = min(max(end, start + self.block_size), self.size) - 1
+        data = self.http.get_range(self.name, start, last, self.validator)
+        self.add_segment(start, data)
+        return data, start
+
+    def read(self, n=-1):
+        end = self.size if n is None or n < 0 else min(self.pos + n, self.size)
+        if end <= self.pos:
+            return ''
+        data, first = self.fetch(self.pos, end)
+        result = data[self.pos - first:end - first]
+        self.pos = end
+        return result
+
+    def seek(self, offset, whence=0):
+        if whence == 1:
+            offset += self.pos
+        elif whence == 2:
+            offset += self.size
+        if offset < 0:
+            raise IOError('{0!r}: seek before start of file'.format(self.name))
+        self.pos = offset
+
+    def tell(self):
+        return self.pos
+
+    def close(self):
+        self.segments = []
+
+
+# The C-accelerated loader is much faster, if PyYAML was built with it.
+YAML_LOADER = getattr(yaml, 'CSafeLoader', yaml.SafeLoader)
+
+def parse_spec(data, content_type='application/yaml'):
+    """Parse the text of a map file or recipe.
+
+    Arguments --
+        data -- JSON or YAML text
+        content_type (optional) -- 'application/json'
+            if the text is JSON; otherwise it is YAML
+
+    Returns --
+        the parsed spec (generally a dict or list)
+    """
+    if content_type == 'application/json':
+        return json.loads(data)
+    return yaml.load(data, Loader=YAML_LOADER)
+
+
+class SpecCache(object):
+    """A directory of parsed map files and recipes, named by a hash of their text.
+
+    The parsed specs are saved with marshal, which
+    loads far faster than parsing the YAML again.
+    """
+    version = 1
+
+    def __init__(self, dir_path):
+        self.dir_path = dir_path
+        if not os.path.isdir(dir_path):
+            os.makedirs(dir_path)
+
+    def _get_file_path(self, data, content_type):
+        # The marshal format can change between Python versions.
+        key = hashlib.sha1('{0} {1} {2}\n'.format(self.version, sys.version_info[:2], content_type))
+        key.update(data)
+        return os.path.join(self.dir_path, key.hexdigest() + '.spec')
+
+    def parse(self, data, content_type='application/yaml'):
+        """Return the spec parsed from data (as for parse_spec)."""
+        file_path = self._get_file_path(data, content_type)
+        try:
+            with open(file_path, 'rb') as strm:
+                return marshal.load(strm)
+        except (IOError, EOFError, ValueError, TypeError):
+            pass # Not in the cache, or unreadable.
+
+        spec = parse_spec(data, content_type)
+        try:
+            bytes = marshal.dumps(spec)
+        except ValueError:
+            return spec # Contains something marshal cannot store, such as a date.
+        fd, temp_path = tempfile.mkstemp(dir=self.dir_path, suffix='.tmp')
+        with os.fdopen(fd, 'wb') as strm:
+            strm.write(bytes)
+        replace_file(temp_path, file_path)
+        return spec
+
+
+class LockStore(object):
+    """A directory of downloaded files named by their SHA-256 hash.
+
+    The lockfile, lock.json, records which file each URL gave,
+    so that later builds can use exactly the same files
+    without going back to the network. It is written by save,
+    once everything needed has been added.
+
+    Arguments --
+        dir_path -- where to keep the files and lockfile
+        offline (optional) -- if true, files are only got from the store
+            (see Loader.get_url_stream)
+    """
+    def __init__(self, dir_path, offline=False):
+        self.dir_path = dir_path
+        self.offline = offline
+        self.lock_path = os.path.join(dir_path, 'lock.json')
+        if os.path.exists(self.lock_path):
+            with open(self.lock_path, 'rb') as strm:
+                self.lock = json.load(strm)
+        elif offline:
+            raise CouldNotLoad('{0!r}: no lockfile'.format(self.lock_path))
+        else:
+            if not os.path.isdir(dir_path):
+                os.makedirs(dir_path)
+            self.lock = {}
+        self._lock = threading.Lock()
+
+    def _get_file_path(self, digest):
+        return os.path.join(self.dir_path, digest[:2], digest)
+
+    def put(self, url, meta, strm, final_url=None):
+        """Add the data read from this stream to the store, as downloaded from url.
+
+        Arguments --
+            final_url (optional) -- where the data actually came from,
+                if url had to be unwrapped to find it
+
+        Returns --
+            meta, strm -- to use in place of the ones passed in
+        """
+        digest = hashlib.sha256()
+        fd, temp_path = tempfile.mkstemp(dir=self.dir_path)
+        try:
+            with os.fdopen(fd, 'wb') as out:
+                while True:
+                    chunk = strm.read(64 * 1024)
+                    if not chunk:
+                        break
+                    digest.update(chunk)
+                    out.write(chunk)
+        except:
+            os.remove(temp_path)
+            raise
+        finally:
+            strm.close()
+        digest = digest.hexdigest()
+        file_path = self._get_file_path(digest)
+        if os.path.exists(file_path):
+            os.remove(temp_path)
+        else:
+            if not os.path.isdir(os.path.dirname(file_path)):
+                try:
+                    os.makedirs(os.path.dirname(file_path))
+                except OSError:
+                    pass # Probably made by another process just now.
+            replace_file(temp_path, file_path)
+        entry = {'sha256': digest, 'content-type': meta.get('content-type'), 'final': final_url or url}
+        with self._lock:
+            self.lock[url] = entry
+        return {'content-type': entry['content-type']}, open(file_path, 'rb')
+
+    def open(self, url):
+        """Get the file downloaded from this URL, checking it has not changed.
+
+        Returns --
+            meta, strm (as for Loader.get_url_stream)
+
+        Raises --
+            CouldNotLoad -- if the URL is not in the lockfile,
+                or the file is missing or does not match its hash
+        """
+        entry = self.lock.get(url)
+        if not entry:
+            raise CouldNotLoad('{0!r}: not in lockfile {1!r}'.format(url, self.lock_path))
+        try:
+            strm = open(self._get_file_path(entry['sha256']), 'rb')
+        except IOError, e:
+            raise CouldNotLoad('{0!r}: missing from store: {1}'.format(url, e))
+        digest = hashlib.sha256()
+        while True:
+            chunk = strm.read(64 * 1024)
+            if not chunk:
+                break
+            digest.update(chunk)
+        if digest.hexdigest() != entry['sha256']:
+            strm.close()
+            raise CouldNotLoad('{0!r}: stored file does not match hash {1}'.format(url, entry['sha256']))
+        strm.seek(0)
+        return {'content-type': entry['content-type']}, strm
+
+    def save(self):
+        """Write the lockfile."""
+        fd, temp_path = tempfile.mkstemp(dir=self.dir_path)
+        with os.fdopen(fd, 'wb') as strm, self._lock:
+            json.dump(self.lock, strm, indent=4, sort_keys=True)
+        replace_file(temp_path, self.lock_path)
+
+
 class Loader(object):
-    def __init__(self):
+    """Fetches maps, recipes, and packs given specs or URLs.
+
+    Arguments --
+        spool_size (optional) -- packs downloaded over HTTP are kept
+            in memory up to this many bytes, and in a temporary
+            file if they are bigger
+        http (optional) -- HttpClient to make requests with
+        spec_cache (optional) -- SpecCache for parsed map files and recipes
+        range_requests (optional) -- if true (the default), packs
+            on servers that support HTTP Range requests are
+            read a piece at a time (see HttpClient.open_ranged)
+            instead of being downloaded in full
+        unwrap_cache (optional) -- unwrapper.UnwrapCache for remembering
+            where pack URLs lead between runs
+        lock_store (optional) -- LockStore to keep everything
+            downloaded in, or (if it is offline) to get it from
+    """
+    def __init__(self, spool_size=8 * 1024 * 1024, http=None, spec_cache=None, range_requests=True,
+            unwrap_cache=None, lock_store=None):
         self._specs = {}
         self._things = {}
         self._schemes = {}
         self._locals = []
-        self._unwrapper = unwrapper.Unwrapper(_get_http())
+        self.http = http or HttpClient()
+        self._unwrapper = unwrapper.Unwrapper(self.http, unwrap_cache)
+        self._prefetched = {}
+        self.spool_size = spool_size
+        self.spec_cache = spec_cache
+        self.range_requests = range_requests
+        self.lock_store = lock_store
+
+    @property
+    def unwrap_cache(self):
+        """The unwrapper.UnwrapCache used when unwrapping pack URLs, or None."""
+        return self._unwrapper.cache
+
+    @unwrap_cache.setter
+    def unwrap_cache(self, cache):
+        self._unwrapper.cache = cache
 
     def add_scheme(self, prefix, func):
         self._schemes[prefix] = func
@@ -254,12 +887,7 @@ class Loader(object):
                 meta is a dict containing 'content-type'
                 strm is a file-like object
         """
-        # Knowledge that some HTTP URLs are available locally:
-        for prefix, dir_path in self._locals:
-            if url.startswith(prefix):
-                file_path = os.path.join(dir_path, url[len(prefix):])
-                url = url_from_file_path(file_path)
-                break
+        url = self._resolve_local(url)
 
         if url.startswith('file://'):
             file_path = url[7:]
@@ -280,15 +908,12 @@ class Loader(object):
             # XXX Allow for more content-types
 
         if url.startswith('http'):
-            # Now use the unwrapper in case it was an indirection URL.
-            res = self._unwrapper.unwrap(url)
-            if 'final' in res:
-                url = res['final']
-
-            response, body = _get_http().request(url)
-            if response['status'] in ['200', '304']:
-                return response, StringIO(body)
-            raise CouldNotLoad('{0!r}: could not load: status={1}'.format(url, response['status']))
+            if self.lock_store and self.lock_store.offline:
+                return self.lock_store.open(url)
+            final_url, meta, strm = self._get_http_stream(url, ext)
+            if self.lock_store:
+                return self.lock_store.put(url, meta, strm, final_url)
+            return meta, strm
 
         p = url.find(':')
         if p > 0:
@@ -299,6 +924,78 @@ class Loader(object):
 
         raise CouldNotLoad('{0!r}: unknown URL scheme'.format(url))
 
+    def _get_http_stream(self, url, ext):
+        """Download from this URL, unwrapping it first if need be.
+
+        Returns --
+            final_url, meta, strm
+        """
+        if ext == 'zip' and url in self._prefetched:
+            return self._prefetched.pop(url)
+
+        # Now use the unwrapper in case it was an indirection URL.
+        res = self._unwrapper.unwrap(url)
+        if 'final' in res:
+            url = res['final']
+
+        if ext == 'zip':
+            meta, strm = self._open_zip(url)
+            return url, meta, strm
+        response, body = self.http.request(url)
+        if response['status'] in ['200', '304']:
+            return url, response, StringIO(body)
+        raise CouldNotLoad('{0!r}: could not load: status={1}'.format(url, response['status']))
+
+    def _resolve_local(self, url):
+        """Knowledge that some HTTP URLs are available locally."""
+        for prefix, dir_path in self._locals:
+            if url.startswith(prefix):
+                file_path = os.path.join(dir_path, url[len(prefix):])
+                return url_from_file_path(file_path)
+        return url
+
+    def prefetch(self, urls, workers=4):
+        """Download these packs concurrently, ahead of their being needed.
+
+        Arguments --
+            urls -- HTTP URLs of packs
+            workers (optional) -- how many downloads to run at once
+
+        Each download is kept until the first call of
+        get_url_stream for that URL with ext='zip'.
+        Errors are ignored here; they will be reported
+        when the pack is actually needed.
+        Nothing is downloaded when working offline (see LockStore).
+        """
+        if self.lock_store and self.lock_store.offline:
+            return
+        urls = set(url for url in urls
+                if url.startswith('http') and url not in self._prefetched
+                and self._resolve_local(url) == url)
+        if not urls:
+            return
+        pool = ThreadPool(min(workers, len(urls)))
+        try:
+            results = pool.map(self._prefetch_one, urls)
+        finally:
+            pool.terminate()
+        for url, result in results:
+            if result:
+                self._prefetched[url] = result
+
+    def _prefetch_one(self, url):
+        try:
+            final_url = self._unwrapper.unwrap(url).get('final', url)
+            meta, strm = self._open_zip(final_url)
+            return url, (final_url, meta, strm)
+        except Exception:
+            return url, None
+
+    def _open_zip(self, url):
+        if self.range_requests and not self.lock_store: # The store needs the whole file.
+            return self.http.open_ranged(url, self.spool_size)
+        return self.http.get_spooled(url, self.spool_size)
+
     def get_bytes(self, spec, base=None):
         """Given a spec, return the data at the location specified.
 
@@ -325,13 +1022,20 @@ class Loader(object):
         if spec:
             return spec
         meta, strm = self.get_url_stream(url, ext=ext)
-        if meta['content-type'] == 'application/json':
-            spec = json.load(strm)
-        else:
-            spec = yaml.load(strm)
+        try:
+            data = strm.read()
+        finally:
+            strm.close()
+        spec = self.parse_spec(data, meta['content-type'])
         self._specs[url] = spec
         return spec
 
+    def parse_spec(self, data, content_type='application/yaml'):
+        """Parse a map file or recipe, using the spec cache if there is one."""
+        if self.spec_cache:
+            return self.spec_cache.parse(data, content_type)
+        return parse_spec(data, content_type)
+
 
 class ResourceBase(object):
     def __init__(self, name):
@@ -351,6 +1055,38 @@ class ResourceBase(object):
         """Has this resource been modified since this date?"""
         return self.get_last_modified() > then
 
+    def get_raw_zip_entry(self):
+        """Return this resource as already-compressed ZIP data, if it has it.
+
+        Returns --
+            a tuple (COMPRESS_TYPE, CRC, FILE_SIZE, DATA)
+            suitable for write_zip_entry, or None
+        """
+        return None
+
+    def get_zip_entry(self, compress_type=ZIP_DEFLATED):
+        """Return the ZIP data for this resource, compressing it if need be.
+
+        Arguments --
+            compress_type (optional) -- ZIP_STORED or ZIP_DEFLATED;
+                used only if the resource has no raw entry
+        """
+        entry = self.get_raw_zip_entry()
+        if entry:
+            return entry
+        if compress_type == ZIP_STORED:
+            return store_entry(self.get_bytes())
+        return deflate_entry(self.get_bytes())
+
+    def get_fingerprint(self):
+        """Return a hash that changes whenever the content of this resource does.
+
+        The default is a hash of the bytes themselves;
+        generated resources instead hash their inputs
+        so they can be fingerprinted without being generated.
+        """
+        return hashlib.sha1(self.get_bytes()).hexdigest()
+
 
 class TextResource(ResourceBase):
     """A document whose content is a literal string."""
@@ -370,6 +1106,25 @@ class TextResource(ResourceBase):
         return self.last_modified
 
 
+class SourceTextResource(TextResource):
+    """A text file from a source pack, read when its content is first needed."""
+    def __init__(self, source, name):
+        ResourceBase.__init__(self, name)
+        self.source = source
+        self.content = None
+
+    def get_content(self):
+        if self.content is None:
+            self.content = self.source.get_resource_bytes(self.name).decode('UTF-8')
+        return self.content
+
+    def get_last_modified(self):
+        return self.source.get_resource_last_modified(self.name)
+
+    def get_raw_zip_entry(self):
+        return self.source.get_resource_raw_zip_entry(self.name)
+
+
 class NotInPack(Exception):
     def __init__(self, name, pack):
         self.name = name
@@ -381,6 +1136,10 @@ class PackBase(object):
 
     Supplies two main features: resources (files) and maps
     (which say how textures are arranged within resources)."""
+
+    # If true, PNG files are not compressed a second time when written to a ZIP.
+    store_png = False
+
     def __init__(self, atlas):
         self.atlas = atlas
 
@@ -403,10 +1162,87 @@ class PackBase(object):
         """A list of all resources in the pack."""
         raise NotImplementedError('{0}.get_resource_names'.format(self.__class__.__name__))
 
-    def write_to(self, strm):
-        with ZipFile(strm, 'w', ZIP_DEFLATED) as zip:
-            for name in sorted(self.get_resource_names()):
-                zip.writestr(name, self.get_resource(name).get_bytes())
+    def write_to(self, strm, workers=None, processes=False,
+            previous_pack=None, previous_manifest=None):
+        """Write the pack as a ZIP archive.
+
+        Arguments --
+            strm -- a file name or a file-like object
+            workers (optional) -- number of workers used to render
+                and compress resources; default is to do
+                everything in this thread
+            processes (optional) -- if true, the workers
+                are processes rather than threads; resources
+                are still rendered in this process, and only
+                the compression is farmed out
+            previous_pack, previous_manifest (optional) --
+                a SourcePack for an earlier build of this pack,
+                and the result of calling get_manifest at the time;
+                entries whose fingerprints have not changed
+                are copied from the previous pack instead of
+                being generated again
+
+        Entries are always written in sorted order,
+        so the archive does not depend on how many workers there are.
+        """
+        names = sorted(self.get_resource_names())
+        reused = {}
+        if previous_pack and previous_manifest:
+            previous_names = set(previous_pack.get_resource_names())
+            for name, fingerprint in self.get_manifest().items():
+                if name in previous_names and previous_manifest.get(name) == fingerprint:
+                    reused[name] = previous_pack.get_resource_raw_zip_entry(name)
+
+        def make_zip_entry(name):
+            return reused.get(name) or self._make_zip_entry(name)
+
+        pool = None
+        if not workers:
+            entries = itertools.imap(make_zip_entry, names)
+        elif processes:
+            pool = Pool(workers)
+            entries = []
+            for name in names:
+                res = self.get_resource(name)
+                if name in reused:
+                    entries.append(reused[name])
+                elif self._get_compress_type(name) == ZIP_STORED:
+                    entries.append(res.get_zip_entry(ZIP_STORED))
+                else:
+                    entries.append(res.get_raw_zip_entry()
+                            or pool.apply_async(deflate_entry, (res.get_bytes(),)))
+        else:
+            pool = ThreadPool(workers)
+            entries = pool.imap(make_zip_entry, names)
+        try:
+            with ZipFile(strm, 'w', ZIP_DEFLATED) as zip:
+                for name, entry in itertools.izip(names, entries):
+                    if hasattr(entry, 'get'):
+                        entry = entry.get() # Result from the process pool.
+                    write_zip_entry(zip, name, entry)
+        finally:
+            if pool:
+                pool.terminate()
+
+    def _get_compress_type(self, name):
+        if self.store_png and name.endswith('.png'):
+            return ZIP_STORED
+        return ZIP_DEFLATED
+
+    def _make_zip_entry(self, name):
+        return self.get_resource(name).get_zip_entry(self._get_compress_type(name))
+
+    def get_manifest(self):
+        """Return a dict mapping resource names to their fingerprints.
+
+        Save this alongside the ZIP archive and pass it
+        to write_to next time to skip regenerating
+        resources whose inputs have not changed.
+        The fingerprints include how each entry is compressed
+        (see store_png), so that changing it is not skipped.
+        """
+        return dict((name, '{0}:{1}'.format(self.get_resource(name).get_fingerprint(), self._get_compress_type(name)))
+                for name in self.get_resource_names())
 
     def get_last_modified(self):
         """Return a datetime object giving the last time a resource was modified.
@@ -439,13 +1275,63 @@ class PackBase(object):
         return self.__unicode__().encode('UTF-8')
 
 
+def deflate_entry(bytes):
+    """Compress data the way ZipFile.writestr would.
+
+    This is separate from writing the entry
+    so that it can be done by a worker thread or process.
+
+    Returns --
+        a tuple (COMPRESS_TYPE, CRC, FILE_SIZE, DATA)
+        to pass to write_zip_entry
+    """
+    co = zlib.compressobj(zlib.Z_DEFAULT_COMPRESSION, zlib.DEFLATED, -15)
+    data = co.compress(bytes) + co.flush()
+    return ZIP_DEFLATED, zlib.crc32(bytes) & 0xffffffff, len(bytes), data
+
+def store_entry(bytes):
+    """Like deflate_entry but without the compression."""
+    return ZIP_STORED, zlib.crc32(bytes) & 0xffffffff, len(bytes), bytes
+
+def write_zip_entry(zip, name, entry):
+    """Add an already-compressed entry to a ZIP archive.
+
+    Arguments --
+        zip -- a ZipFile open for writing
+        name -- the name of the file within the archive
+        entry -- a tuple (COMPRESS_TYPE, CRC, FILE_SIZE, DATA)
+            as returned by deflate_entry
+
+    This does what ZipFile.writestr does, minus the compression.
+    """
+    compress_type, crc, file_size, data = entry
+    zinfo = ZipInfo(name, time.localtime(time.time())[:6])
+    zinfo.compress_type = compress_type
+    zinfo.external_attr = 0600 << 16
+    zinfo.file_size = file_size
+    zinfo.compress_size = len(data)
+    zinfo.CRC = crc
+    zinfo.header_offset = zip.fp.tell()
+    zip._writecheck(zinfo)
+    zip64 = zinfo.file_size > ZIP64_LIMIT or zinfo.compress_size > ZIP64_LIMIT
+    if not zip._allowZip64 and (zip64 or zinfo.header_offset > ZIP64_LIMIT):
+        raise zipfile.LargeZipFile('{0!r}: would require ZIP64 extensions'.format(name))
+    zip._didModify = True
+    zip.fp.write(zinfo.FileHeader(zip64))
+    zip.fp.write(data)
+    zip.fp.flush()
+    zip.filelist.append(zinfo)
+    zip.NameToInfo[zinfo.filename] = zinfo
+
+
 class RecipePack(PackBase):
     """A texture pack assembled from other resources."""
 
-    def __init__(self, label, desc, atlas=None):
+    def __init__(self, label, desc, atlas=None, store_png=False):
         super(RecipePack, self).__init__(atlas or Atlas())
         self.label = label
         self.desc = desc
+        self.store_png = store_png
 
         self.resources = {}
         self.add_resource(TextResource('pack.txt', u'{label}\n{desc}'.format(label=label, desc=desc)))
@@ -463,8 +1349,8 @@ class RecipePack(PackBase):
         return self.resources.keys()
 
     def is_modified_since(self, then):
-        for n in self.get_resource_names():
-            if n != 'pack.txt' and self.get_resource(n).is_modified_since(then):
+        for n, res in self.resources.iteritems():
+            if n != 'pack.txt' and res.is_modified_since(then):
                 return True
         return False
 
@@ -472,22 +1358,184 @@ class RecipePack(PackBase):
         return '<RecipePack {0!r}>'.format(self.label)
 
 
+class DirectoryIndex(object):
+    """A snapshot of the files in a directory tree, with their sizes and modification times.
+
+    `files` maps each file’s path (relative, with / separators)
+    to (SIZE, MTIME). The snapshot is made once and brought up
+    to date by refresh, which lists again only those directories
+    whose modification times have changed. (A file rewritten in place
+    does not change its directory, so is not noticed by refresh.)
+    """
+    def __init__(self, dir_path):
+        self.dir_path = dir_path
+        self.files = {}
+        self._dirs = {} # Maps subdir to (MTIME, FILES, SUBDIRS).
+        self._lock = threading.Lock()
+        self._scan('')
+
+    def _get_path(self, subdir):
+        return os.path.join(self.dir_path, *subdir.split('/')) if subdir else self.dir_path
+
+    def _scan(self, subdir):
+        """Add the files in this directory, and any subdirectories not already known."""
+        dir_path = self._get_path(subdir)
+        dir_mtime = os.stat(dir_path).st_mtime
+        file_names, subdirs = [], []
+        for entry in os.listdir(dir_path):
+            name = subdir + '/' + entry if subdir else entry
+            entry_path = os.path.join(dir_path, entry)
+            try:
+                s = os.stat(entry_path)
+            except OSError:
+                continue # Deleted since we listed it, or a broken link.
+            if stat.S_ISDIR(s.st_mode):
+                if not os.path.islink(entry_path): # Like os.walk, do not follow links.
+                    subdirs.append(name)
+            else:
+                file_names.append(name)
+                self.files[name] = s.st_size, s.st_mtime
+        old = self._dirs.get(subdir)
+        self._dirs[subdir] = dir_mtime, file_names, subdirs
+        for name in subdirs:
+            if name not in self._dirs:
+                self._scan(name)
+        if old:
+            for name in set(old[2]) - set(subdirs):
+                self._forget(name)
+
+    def _forget(self, subdir):
+        dir_mtime, file_names, subdirs = self._dirs.pop(subdir)
+        for name in file_names:
+            self.files.pop(name, None)
+        for name in subdirs:
+            self._forget(name)
+
+    def refresh(self):
+        """Catch up with files added to or removed from the directory tree."""
+        with self._lock:
+            for subdir in sorted(self._dirs):
+                old = self._dirs.get(subdir)
+                if not old:
+                    continue # Removed along with its parent.
+                try:
+                    dir_mtime = os.stat(self._get_path(subdir)).st_mtime
+                except OSError:
+                    dir_mtime = None
+                if dir_mtime != old[0]:
+                    for name in old[1]:
+                        self.files.pop(name, None)
+                    if dir_mtime is None:
+                        self._forget(subdir)
+                    else:
+                        self._scan(subdir)
+
+    def get_last_modified(self):
+        """Return the newest of the files’ modification times."""
+        with self._lock:
+            return max(mtime for size, mtime in self.files.itervalues())
+
+
+class ImageCache(object):
+    """Keeps recently used decoded images, up to a total size in bytes.
+
+    Least-recently used images are evicted first. An image bigger
+    than the whole budget is kept only until the next one is stored.
+    Counts of hits, misses, and evictions are kept
+    so that the budget can be tuned (see get_stats).
+
+    Arguments --
+        max_bytes (optional) -- how much memory the decoded
+            images may take up (estimated as width × height × bands)
+    """
+    def __init__(self, max_bytes=256 * 1024 * 1024):
+        self.max_bytes = max_bytes
+        self.total_bytes = 0
+        self.hits = self.misses = self.evictions = 0
+        self._images = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        """Return the image stored under this key, or None."""
+        with self._lock:
+            entry = self._images.pop(key, None)
+            if entry is None:
+                self.misses += 1
+                return None
+            self._images[key] = entry # Now most recently used.
+            self.hits += 1
+            return entry[0]
+
+    def put(self, key, im):
+        """Store this image, evicting others if need be to stay in budget."""
+        size = im.size[0] * im.size[1] * len(im.getbands())
+        with self._lock:
+            old = self._images.pop(key, None)
+            if old:
+                self.total_bytes -= old[1]
+            self._images[key] = im, size
+            self.total_bytes += size
+            while self.total_bytes > self.max_bytes and len(self._images) > 1:
+                _, (_, old_size) = self._images.popitem(last=False)
+                self.total_bytes -= old_size
+                self.evictions += 1
+
+    def get_stats(self):
+        """Return a dict of hits, misses, evictions, count, and bytes."""
+        with self._lock:
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'count': len(self._images),
+                'bytes': self.total_bytes,
+            }
+
+
 class SourcePack(PackBase):
-    """A texture pack that gets resources from a ZIP file or directory."""
-    def __init__(self, zip_data, atlas):
+    """A texture pack that gets resources from a ZIP file or directory.
+
+    Arguments --
+        zip_data -- file name, directory name, or stream
+        atlas -- describes the images in the pack
+        image_cache (optional) -- ImageCache for decoded images,
+            which may be shared with other packs;
+            by default the pack has one of its own
+    """
+    def __init__(self, zip_data, atlas, image_cache=None):
         super(SourcePack, self).__init__(atlas)
+        self.image_cache = ImageCache() if image_cache is None else image_cache
+        self._image_key = object() # Distinguishes our images in a shared cache.
         if (isinstance(zip_data, basestring)
                 and os.path.isdir(zip_data)):
             self.dir_path = zip_data.rstrip('\\/')
         else:
             self.zip = ZipFile(zip_data)
+            self._zip_lock = threading.Lock() # ZipFile shares one file pointer between reads.
         self.loaded_resources = weakref.WeakValueDictionary()
 
     def __del__(self):
+        self.close()
+
+    def __unicode__(self):
+        if hasattr(self, 'dir_path'):
+            return '<SourcePack {0!r}>'.format(self.dir_path)
+        return '<SourcePack {0!r}>'.format(getattr(getattr(self, 'zip', None), 'filename', None))
+
+    def close(self):
+        """Close the ZIP file, if any."""
         if hasattr(self, 'zip'):
             self.zip.close()
             del self.zip
 
+    @property
+    def index(self):
+        """DirectoryIndex of the files in a directory pack, made when first needed."""
+        index = getattr(self, '_index', None)
+        if index is None:
+            index = self._index = DirectoryIndex(self.dir_path)
+        return index
+
     def get_resource(self, name):
         """Get the named resource
 
@@ -497,14 +1545,19 @@ class SourcePack(PackBase):
         Returns --
             A resource (subclass of ResourceBase)
 
+        Raises --
+            NotInPack -- if this is a directory pack
+                and it has no file by that name
         """
         res = self.loaded_resources.get(name)
         if res:
             return res
+        if hasattr(self, 'dir_path') and name not in self.index.files:
+            self.index.refresh()
+            if name not in self.index.files:
+                raise NotInPack(name, self)
         if name.endswith('.txt'):
-            text = self.get_resource_bytes(name).decode('UTF-8')
-            last_modified = self.get_resource_last_modified(name)
-            res = TextResource(name, text, last_modified)
+            res = SourceTextResource(self, name)
         else:
             res = SourceResource(self, name)
         self.loaded_resources[name] = res
@@ -514,15 +1567,89 @@ class SourcePack(PackBase):
         if hasattr(self, 'dir_path'):
             with open(os.path.join(self.dir_path, name), 'rb') as strm:
                 return strm.read()
-        return self.zip.read(name)
+        with self._zip_lock:
+            self._fetch_entry(self.zip.getinfo(name))
+            return self.zip.read(name)
+
+    def get_resource_image(self, name):
+        """Helper function to get the decoded image of a resource.
+
+        Used by the resource’s get_image method.
+        Images in modes P, L, RGB, and RGBA are kept in that mode
+        (see keeps_native_mode); others are converted to RGBA."""
+        key = self._image_key, name
+        im = self.image_cache.get(key)
+        if im is None:
+            im = Image.open(StringIO(self.get_resource_bytes(name)))
+            if keeps_native_mode(im):
+                im.load()
+            else:
+                im = im.convert('RGBA')
+            self.image_cache.put(key, im)
+        return im
+
+    def get_resource_raw_zip_entry(self, name):
+        """Helper function to get the compressed data of a resource.
+
+        Used by the resource’s get_raw_zip_entry method.
+        Returns None if the pack is a directory or the entry
+        is encrypted or compressed some way we can’t write.
+        """
+        if hasattr(self, 'dir_path'):
+            return None
+        with self._zip_lock:
+            zinfo = self.zip.getinfo(name)
+            if zinfo.flag_bits & 0x01 or zinfo.compress_type not in (ZIP_STORED, ZIP_DEFLATED):
+                return None
+            self._fetch_entry(zinfo)
+            fp = self.zip.fp
+            fp.seek(zinfo.header_offset)
+            header = struct.unpack(zipfile.structFileHeader, fp.read(zipfile.sizeFileHeader))
+            if header[zipfile._FH_SIGNATURE] != zipfile.stringFileHeader:
+                raise zipfile.BadZipfile('{0!r}: bad local file header'.format(name))
+            fp.seek(header[zipfile._FH_FILENAME_LENGTH] + header[zipfile._FH_EXTRA_FIELD_LENGTH], 1)
+            data = fp.read(zinfo.compress_size)
+        return zinfo.compress_type, zinfo.CRC, zinfo.file_size, data
+
+    def get_resource_fingerprint(self, name):
+        """Helper function to fingerprint a resource without reading it.
+
+        Used by the resource’s get_fingerprint method.
+        Entries in a ZIP are identified by their name, CRC, and size
+        from the central directory. Returns None if the pack is a directory.
+        """
+        if hasattr(self, 'dir_path'):
+            return None
+        zinfo = self.zip.getinfo(name)
+        return hashlib.sha1('{0}\n{1:08x}\n{2}'.format(zinfo.filename, zinfo.CRC, zinfo.file_size)).hexdigest()
+
+    def _fetch_entry(self, zinfo):
+        """If the ZIP is remote (an HttpRangeFile), get all of this entry in one request.
+
+        The local header’s extra field is often longer than the central
+        directory’s (Info-ZIP adds to its timestamps, for example), so some
+        slack is allowed for, and the sizes in the local header are checked
+        once it has been fetched.
+        """
+        fetch = getattr(self.zip.fp, 'fetch', None)
+        if fetch:
+            start = zinfo.header_offset
+            data_start = start + zipfile.sizeFileHeader
+            data, first = fetch(start, data_start + len(zinfo.orig_filename)
+                    + len(zinfo.extra) + zinfo.compress_size + 256)
+            header = data[start - first:data_start - first]
+            if len(header) == zipfile.sizeFileHeader:
+                fheader = struct.unpack(zipfile.structFileHeader, header)
+                fetch(start, data_start + fheader[zipfile._FH_FILENAME_LENGTH]
+                        + fheader[zipfile._FH_EXTRA_FIELD_LENGTH] + zinfo.compress_size)
 
     def get_resource_last_modified(self, name):
         """Helper function to get last-modified of a resource.
 
         Used by the resource’s get_last_modified method."""
         if hasattr(self, 'dir_path'):
-            file_path = os.path.join(self.dir_path, name)
-            t = os.stat(file_path).st_mtime
+            size_mtime = self.index.files.get(name)
+            t = size_mtime[1] if size_mtime else os.stat(os.path.join(self.dir_path, name)).st_mtime
             return datetime.fromtimestamp(t)
         inf = self.zip.getinfo(name)
         return datetime(*inf.date_time)
@@ -530,12 +1657,10 @@ class SourcePack(PackBase):
     def get_resource_names(self):
         # We want all resources, not just recently mentioned ones.
         if hasattr(self, 'dir_path'):
-            for subdir, subdirs, file_names in os.walk(self.dir_path):
-                if subdir.startswith(self.dir_path):
-                    subdir = subdir[len(self.dir_path) + 1:]
-                for file_name in file_names:
-                    if file_name.endswith('.png') or file_name.endswith('.txt'):
-                        yield subdir + '/' + file_name if subdir else file_name
+            self.index.refresh()
+            for name in sorted(self.index.files):
+                if name.endswith('.png') or name.endswith('.txt'):
+                    yield name
         else:
             for name in self.zip.namelist():
                 yield name
@@ -545,7 +1670,7 @@ class SourcePack(PackBase):
         try:
             res = self.get_resource('pack.txt')
             return res.get_content().split('\n', 1)[0]
-        except KeyError:
+        except (KeyError, NotInPack):
             return ''
 
     @property
@@ -553,7 +1678,7 @@ class SourcePack(PackBase):
         try:
             res = self.get_resource('pack.txt')
             return res.get_content().split('\n', 1)[1].rstrip()
-        except (KeyError, IndexError):
+        except (KeyError, IndexError, NotInPack):
             return ''
 
     def get_last_modified(self):
@@ -564,27 +1689,32 @@ class SourcePack(PackBase):
         last-modified time.
         """
         if hasattr(self, 'dir_path'):
-            t = None
-            for subdir, subdirs, files in os.walk(self.dir_path):
-                for file_name in files:
-                    s = os.stat(os.path.join(subdir, file_name))
-                    if not t or s.st_mtime > t:
-                        t = s.st_mtime
-            return datetime.fromtimestamp(t)
+            self.index.refresh()
+            return datetime.fromtimestamp(self.index.get_last_modified())
         # Is a Zip
         ymdhms = max(inf.date_time for inf in self.zip.infolist())
         return datetime(*ymdhms)
 
+    def is_modified_since(self, then):
+        """Return true iff this pack has had a resource changed since the given date.
+
+        Only the directory index or the ZIP’s directory is consulted:
+        no resources are made and no files are read.
+        """
+        return any(self.get_resource_last_modified(n) > then
+                for n in self.get_resource_names())
+
 
 class LazyPack(PackBase):
     """A pack specified by a URL that will be loaded when required.
 
     Actually performing the network operation will be deferred
     until it can no longer be avoided."""
-    def __init__(self, loader, url, atlas):
+    def __init__(self, loader, url, atlas, image_cache=None):
         super(LazyPack, self).__init__(atlas)
         self.loader = loader
         self.url = url
+        self.image_cache = image_cache
         self.pack = None
 
     def get_pack(self):
@@ -592,7 +1722,7 @@ class LazyPack(PackBase):
         if not self.pack:
             meta, strm = self.loader.get_url_stream(self.url, 'zip')
             # XXX exception if wrong type of data?
-            self.pack = SourcePack(strm, self.atlas)
+            self.pack = SourcePack(strm, self.atlas, self.image_cache)
         return self.pack
 
     def get_resource(self, name):
@@ -626,28 +1756,35 @@ class LazyPack(PackBase):
         """
         return self.get_pack().get_last_modified()
 
+    def is_modified_since(self, then):
+        return self.get_pack().is_modified_since(then)
+
 
 class SourceResource(ResourceBase):
     def __init__(self, source, name):
         self.source = source
         self.name = name
-        self.bytes = None
-        self.image = None
+        self.fingerprint = None
 
     def get_bytes(self):
-        if self.bytes is None:
-            self.bytes = self.source.get_resource_bytes(self.name)
-        return self.bytes
+        # Not kept: decoded images are kept by the pack’s ImageCache instead.
+        return self.source.get_resource_bytes(self.name)
+
+    def get_fingerprint(self):
+        if self.fingerprint is None:
+            self.fingerprint = (self.source.get_resource_fingerprint(self.name)
+                    or super(SourceResource, self).get_fingerprint())
+        return self.fingerprint
 
     def get_last_modified(self):
         return self.source.get_resource_last_modified(self.name)
 
+    def get_raw_zip_entry(self):
+        """Pass the entry through from the source ZIP without recompressing it."""
+        return self.source.get_resource_raw_zip_entry(self.name)
+
     def get_image(self):
-        if self.image is None:
-            strm = StringIO(self.get_bytes())
-            self.image = Image.open(strm)
-            self.image = self.image.convert('RGBA') # Upgrades to a format without palett
-        return self.image
+        return self.source.get_resource_image(self.name)
 
 
 class RenamedResource(ResourceBase):
@@ -661,11 +1798,36 @@ class RenamedResource(ResourceBase):
     def get_image(self):
         return self.res.get_image()
 
+    def get_raw_zip_entry(self):
+        return self.res.get_raw_zip_entry()
+
+    def get_fingerprint(self):
+        return self.res.get_fingerprint()
+
     def get_last_modified(self):
         return self.res.get_last_modified()
 
+    def is_modified_since(self, then):
+        return self.res.is_modified_since(then)
+
 
 class MapBase(object):
+    """Base class for maps.
+
+    Subclasses supply `names`, a list of cell names,
+    and `boxes`, a dict mapping each name to its box.
+    """
+    def get_box(self, name):
+        """Return the box (LEFT, TOP, RIGHT, BOTTOM) of the named cell.
+
+        Raises --
+            NotInMap -- if there is no cell with that name
+        """
+        try:
+            return self.boxes[name]
+        except KeyError:
+            raise NotInMap(name, self)
+
     def get_alts_list(self):
         """Which tiles in this map are alteratives for others?
 
@@ -770,19 +1932,17 @@ class GridMap(MapBase):
             raise BadMap('Image must be at least as wide and tall as one cell ({0}×{1} image, {2}×{3} cell)'.format(im_wd, im_ht, self.cell_wd, self.cell_ht),
             (source_box, cell_box, names))
 
+        # Index of boxes by cell name. If a name is repeated, the first one wins.
+        self.boxes = {}
+        for i, name in enumerate(names):
+            if name not in self.boxes:
+                u, v = i % self.nx, i // self.nx
+                self.boxes[name] = (self.im_left + self.cell_wd * u, self.im_top + self.cell_ht * v,
+                    self.im_left + self.cell_wd * (u + 1), self.im_top + self.cell_ht * (v + 1))
+
     def get_css_background_dimens(self):
         return self.nx * self.cell_wd, self.ny * self.cell_ht
 
-    def get_box(self, name):
-        try:
-            i = self.names.index(name)
-        except ValueError:
-            raise NotInMap(name, self)
-        u, v = i % self.nx, i // self.nx
-        result = (self.im_left + self.cell_wd * u, self.im_top + self.cell_ht * v,
-            self.im_left + self.cell_wd * (u + 1), self.im_top + self.cell_ht * (v + 1))
-        return result
-
 class CompositeMap(MapBase):
     """A map that combines several other maps.
 
@@ -791,13 +1951,10 @@ class CompositeMap(MapBase):
     def __init__(self, maps):
         self.maps = list(maps)
 
-    def get_box(self, name):
-        for m in self.maps:
-            try:
-                return m.get_box(name)
-            except NotInMap:
-                pass
-        raise NotInMap(name, self)
+        # Merge the submaps’ indexes so that earlier maps win.
+        self.boxes = {}
+        for m in reversed(self.maps):
+            self.boxes.update(m.boxes)
 
     @property
     def names(self):
@@ -895,21 +2052,143 @@ def pil_box(left=None, top=None, right=None, bottom=None, x=None, y=None, width=
     return left, top, right, bottom
 
 
+class RenderCache(object):
+    """A directory of generated PNG files, named by a hash of their inputs.
+
+    Entries are evicted least-recently-used first
+    when the files add up to more than max_bytes.
+    The directory is only scanned when first written to and when
+    the running total of what has been stored passes max_bytes.
+    """
+    def __init__(self, dir_path, max_bytes=256 * 1024 * 1024):
+        self.dir_path = dir_path
+        self.max_bytes = max_bytes
+        self._total = None # Bytes in the directory, as far as we know.
+        if not os.path.isdir(dir_path):
+            os.makedirs(dir_path)
+
+    def _get_file_path(self, key):
+        return os.path.join(self.dir_path, key + '.png')
+
+    def get(self, key):
+        """Return the bytes stored under this key, or None."""
+        file_path = self._get_file_path(key)
+        try:
+            with open(file_path, 'rb') as strm:
+                bytes = strm.read()
+            os.utime(file_path, None) # Mark as recently used.
+        except (IOError, OSError):
+            return None
+        return bytes
+
+    def put(self, key, bytes):
+        """Store bytes under this key, then evict old entries if need be."""
+        file_path = self._get_file_path(key)
+        # Threads rendering in parallel share a process ID, so the temp file needs a unique name.
+        fd, temp_path = tempfile.mkstemp(dir=self.dir_path, suffix='.tmp')
+        with os.fdopen(fd, 'wb') as strm:
+            strm.write(bytes)
+        replace_file(temp_path, file_path)
+        if self._total is None:
+            self.evict()
+        else:
+            self._total += len(bytes)
+            if self._total > self.max_bytes:
+                self.evict()
+
+    def evict(self):
+        """Remove least-recently used entries until under the size limit.
+
+        Other processes sharing the directory may be removing
+        entries at the same time; files that vanish are skipped.
+        """
+        entries = []
+        total = 0
+        for file_name in os.listdir(self.dir_path):
+            if file_name.endswith('.png'):
+                file_path = os.path.join(self.dir_path, file_name)
+                try:
+                    st = os.stat(file_path)
+                except OSError:
+                    continue # Evicted by another process just now.
+                entries.append((st.st_mtime, st.st_size, file_path))
+                total += st.st_size
+        entries.sort()
+        for _, size, file_path in entries:
+            if total <= self.max_bytes:
+                break
+            try:
+                os.remove(file_path)
+            except OSError:
+                pass # Evicted by another process just now.
+            total -= size
+        self._total = total
+
+
+# Options for saving PNG files, by profile name.
+# (PIL 1.1.7 optimizes if `optimize` is present at all
+# and ignores `compress_level`; later versions honour both.)
+ENCODE_PROFILES = {
+    'release': {'optimize': True},
+    'fast': {'compress_level': 1},
+}
+
+# Profiles in which generated images are saved as paletted PNGs
+# when that can be done without changing any pixels (see fit_palette).
+PALETTE_PROFILES = frozenset(['release'])
+
+# Part of the fingerprint of every generated image.
+# Increase it whenever a change to the code would make the same inputs
+# give different output, so that images from earlier versions
+# are not taken from a RenderCache or copied from a previous build.
+# (2: images may be paletted, and saved as paletted PNGs.)
+RENDER_VERSION = 2
+
 class ImagingResourceBase(ResourceBase):
-    """Base class for images that are lazily constructed using the Imaging library."""
-    def __init__(self, name):
+    """Base class for images that are lazily constructed using the Imaging library.
+
+    Arguments --
+        name -- the name of the resource
+        render_cache (optional) -- a RenderCache in which
+            the PNG data is looked up and saved
+        encode_profile (optional) -- names one of the
+            ENCODE_PROFILES; 'fast' is quicker to save but makes
+            bigger files than the default, 'release'
+    """
+    def __init__(self, name, render_cache=None, encode_profile='release'):
         super(ImagingResourceBase, self).__init__(name)
+        if encode_profile not in ENCODE_PROFILES:
+            raise ValueError('{0!r}: unknown encode profile (must be one of {1})'.format(
+                    encode_profile, ', '.join(sorted(ENCODE_PROFILES))))
+        self.render_cache = render_cache
+        self.encode_profile = encode_profile
         self._image = None
         self._bytes = None
+        self._fingerprint = None
 
     def _calc(self):
         """Generate the image resource and return the image"""
         raise NotImplementedError('{n}._calc'.format(n=self.__class__.__name__))
 
+    def _get_fingerprint_parts(self):
+        """Return a list of the inputs to _calc, as strings or tuples."""
+        raise NotImplementedError('{n}._get_fingerprint_parts'.format(n=self.__class__.__name__))
+
     def _invalidate(self):
         """Call this if the recipe changes, so cached images should be discarded."""
         self._image = None
         self._bytes = None
+        self._fingerprint = None
+
+    def get_fingerprint(self):
+        """A hash of RENDER_VERSION and the class, encode profile, and inputs of this resource."""
+        if self._fingerprint is None:
+            h = hashlib.sha1('{0}:{1}'.format(RENDER_VERSION, self.__class__.__name__))
+            h.update(self.encode_profile)
+            for part in self._get_fingerprint_parts():
+                h.update(repr(part))
+            self._fingerprint = h.hexdigest()
+        return self._fingerprint
 
     def get_image(self):
         """Get the composite image."""
@@ -920,16 +2199,123 @@ class ImagingResourceBase(ResourceBase):
     def get_bytes(self):
         """Get the bytes representing the composite image in PNG format."""
         if self._bytes is None:
-            strm = StringIO()
-            self.get_image().save(strm, 'PNG', optimize=True)
-            self._bytes = strm.getvalue()
+            key = self.render_cache and self.get_fingerprint()
+            if key:
+                self._bytes = self.render_cache.get(key)
+            if self._bytes is None:
+                im = self.get_image()
+                if self.encode_profile in PALETTE_PROFILES:
+                    im = fit_palette(im)
+                params = dict(ENCODE_PROFILES[self.encode_profile])
+                if im.mode == 'P' and 'transparency' in im.info:
+                    params['transparency'] = im.info['transparency']
+                strm = StringIO()
+                im.save(strm, 'PNG', **params)
+                self._bytes = strm.getvalue()
+                if key:
+                    self.render_cache.put(key, self._bytes)
         return self._bytes
 
 
+def keeps_native_mode(im):
+    """Whether this image can be used in its own mode rather than converted to RGBA.
+
+    These are the modes that compositing and fit_palette understand,
+    with transparency (if any) in a form PNG files can save.
+    """
+    transparency = im.info.get('transparency')
+    if im.mode == 'P':
+        return transparency is None or isinstance(transparency, int)
+    return im.mode == 'RGBA' or im.mode in ('L', 'RGB') and transparency is None
+
+def get_common_mode(ims):
+    """Return the mode in which these images can be combined without conversion.
+
+    This is their mode if they all share one (and, for paletted
+    images, the same palette and transparent colour); otherwise RGBA.
+    """
+    first = ims[0]
+    for im in ims[1:]:
+        if im.mode != first.mode:
+            return 'RGBA'
+        if im.mode == 'P' and (im.getpalette() != first.getpalette()
+                or im.info.get('transparency') != first.info.get('transparency')):
+            return 'RGBA'
+    return first.mode
+
+def fit_palette(im):
+    """Return a paletted copy of this image if it fits in one, or else the image itself.
+
+    The copy must have exactly the same pixels: this means no more than
+    256 colours, all either opaque or fully transparent, and at most one
+    transparent colour (PNG files written by PIL can only have one).
+    The transparent colour, if any, has index 0.
+    """
+    if im.mode not in ('RGB', 'RGBA'):
+        return im
+    colors = im.getcolors(256)
+    if colors is None:
+        return im
+    if im.mode == 'RGB':
+        transparent = []
+        opaque = sorted(color for count, color in colors)
+    else:
+        transparent = [color for count, color in colors if color[3] == 0]
+        opaque = sorted(color for count, color in colors if color[3] == 255)
+        if len(transparent) > 1 or len(transparent) + len(opaque) < len(colors):
+            return im # Would need more transparent colours or partial transparency.
+    palette_colors = transparent + opaque
+    indexes = dict((color, i) for i, color in enumerate(palette_colors))
+    result = Image.new('P', im.size)
+    result.putpalette([c for color in palette_colors for c in color[:3]])
+    result.putdata([indexes[color] for color in im.getdata()])
+    if transparent:
+        result.info['transparency'] = 0
+    return result
+
+def _load_cell(src_im_box_and_mode):
+    src_im, src_box, mode = src_im_box_and_mode
+    cell_im = src_im.crop(src_box)
+    if cell_im.mode != mode:
+        cell_im = cell_im.convert(mode) # Only the cell is converted, not the whole source.
+    cell_im.load() # Crops are lazy; force the pixel work to happen here.
+    return cell_im
+
+def paste_cells(im, cells, pool=None):
+    """Paste cells cropped from source images in to this image.
+
+    Arguments --
+        im -- the image to modify
+        cells -- list of triples (SRC_IM, SRC_BOX, DST_BOX)
+            in the order they are to be pasted (so later
+            cells win if destinations overlap)
+        pool (optional) -- a thread pool used to crop the cells
+            in parallel (PIL releases the GIL for most pixel work)
+
+    Each distinct (SRC_IM, SRC_BOX) pair is cropped only once,
+    however many times it is pasted. The pasting itself is done
+    in order, so the result is the same as pasting the cells one
+    at a time, with or without a pool. Cells from images in
+    a different mode are converted to the mode of im.
+    """
+    keys = []
+    crops = {}
+    for src_im, src_box, _ in cells:
+        key = id(src_im), src_box
+        if key not in crops:
+            crops[key] = src_im, src_box, im.mode
+            keys.append(key)
+    jobs = [crops[k] for k in keys]
+    cell_ims = pool.map(_load_cell, jobs) if pool and len(jobs) > 1 else map(_load_cell, jobs)
+    crops = dict(zip(keys, cell_ims))
+    for src_im, src_box, dst_box in cells:
+        im.paste(crops[id(src_im), src_box], dst_box)
+
+
 class BlankResource(ImagingResourceBase):
     """An image of a given size and blank background."""
-    def __init__(self, name='blank', width=256, height=256, background='transparent'):
-        super(BlankResource, self).__init__(name)
+    def __init__(self, name='blank', width=256, height=256, background='transparent', **kwargs):
+        super(BlankResource, self).__init__(name, **kwargs)
         self.width = width
         self.height = height
         self.background = background
@@ -938,13 +2324,16 @@ class BlankResource(ImagingResourceBase):
         im = Image.new('RGBA', (self.width, self.height), (255, 255, 255, 0))
         return im
 
+    def _get_fingerprint_parts(self):
+        return [(self.width, self.height, self.background)]
+
     def get_last_modified(self):
         return datetime(2011, 11, 20, 11, 54)
 
 
 class CompositeResource(ImagingResourceBase):
     """An image made by replacing some cells in an image with parts of another"""
-    def __init__(self, name, base_res, base_map):
+    def __init__(self, name, base_res, base_map, pool=None, **kwargs):
         """Create a composite resouce (with no substitutions)
 
         Arguments --
@@ -953,10 +2342,15 @@ class CompositeResource(ImagingResourceBase):
             base_res -- a resource to copy as the basis of the new one
             base_map -- the map describing cells in the new resource
                 (this may include cells not in the base resource
-                assuming these cells will be filled in later)"""
-        super(CompositeResource, self).__init__(name)
+                assuming these cells will be filled in later)
+            pool (optional) -- a thread pool (such as
+                multiprocessing.pool.ThreadPool) used to
+                crop cells in parallel; see paste_cells
+            render_cache (optional) -- see ImagingResourceBase"""
+        super(CompositeResource, self).__init__(name, **kwargs)
         self.res = base_res
         self.map = base_map
+        self.pool = pool
         self.replacements = []
 
     def replace(self, source_res, source_map, cells):
@@ -984,23 +2378,38 @@ class CompositeResource(ImagingResourceBase):
 
         We defer generating the image until it is required.
         """
-        im = self.res.get_image().copy()
-        for src_res, src_map, cells in self.replacements:
-            for dst_name, src_name in cells.iteritems():
-                dst_box = self.map.get_box(dst_name)
-                src_box = src_map.get_box(src_name)
-                src_im = src_res.get_image().crop(src_box)
-                im.paste(src_im, dst_box)
+        base_im = self.res.get_image()
+        src_ims = [src_res.get_image() for src_res, _, _ in self.replacements]
+        mode = get_common_mode([base_im] + src_ims)
+        im = base_im.copy() if base_im.mode == mode else base_im.convert(mode)
+        cells = []
+        for (src_res, src_map, cell_names), src_im in zip(self.replacements, src_ims):
+            for dst_name, src_name in cell_names.iteritems():
+                cells.append((src_im, src_map.get_box(src_name), self.map.get_box(dst_name)))
+        paste_cells(im, cells, self.pool)
         return im
 
+    def _get_fingerprint_parts(self):
+        parts = [self.res.get_fingerprint()]
+        for src_res, src_map, cell_names in self.replacements:
+            parts.append(src_res.get_fingerprint())
+            parts.append(sorted((self.map.get_box(dst_name), src_map.get_box(src_name))
+                    for (dst_name, src_name) in cell_names.iteritems()))
+        return parts
+
     def get_last_modified(self):
         return max([self.res.get_last_modified()]
             + [x.get_last_modified() for x, _, _ in self.replacements])
 
+    def is_modified_since(self, then):
+        # Stop at the first newer input.
+        return (self.res.is_modified_since(then)
+            or any(x.is_modified_since(then) for x, _, _ in self.replacements))
+
 
 class PackIconResource(ImagingResourceBase):
-    def __init__(self, res, map, names):
-        super(PackIconResource, self).__init__('pack.png')
+    def __init__(self, res, map, names, **kwargs):
+        super(PackIconResource, self).__init__('pack.png', **kwargs)
         self.res = res
         self.map = map
         self.names = names
@@ -1019,9 +2428,15 @@ class PackIconResource(ImagingResourceBase):
             im.paste(cell_im, dst_box)
         return im
 
+    def _get_fingerprint_parts(self):
+        return [self.res.get_fingerprint(), [self.map.get_box(name) for name in self.names]]
+
     def get_last_modified(self):
         return self.res.get_last_modified()
 
+    def is_modified_since(self, then):
+        return self.res.is_modified_since(then)
+
 
 class UnknownPack(Exception):
     """Raised if you ask a mixer to use a pack it does not know about."""
@@ -1041,6 +2456,41 @@ class MissingParameter(Exception):
         self.param = param_spec
 
 
+def _glob_regex(pattern):
+    # fnmatch.translate appends the flags (?ms), which
+    # cannot be repeated within a combined expression.
+    regex = fnmatch.translate(os.path.normcase(pattern))
+    if regex.endswith('(?ms)'):
+        regex = regex[:-5]
+    return regex
+
+def match_globs(patterns, names):
+    """Match names against several shell-style wildcard patterns at once.
+
+    Equivalent to [fnmatch.filter(names, p) for p in patterns],
+    except that each name is first tested against a single
+    combined regex, so most names are rejected in one test.
+
+    Returns --
+        a list of lists of names, one for each pattern,
+        with names in the order they were supplied
+    """
+    results = [[] for pattern in patterns]
+    if not patterns:
+        return results
+    regexes = [_glob_regex(pattern) for pattern in patterns]
+    any_re = re.compile('|'.join('(?:{0})'.format(regex) for regex in regexes), re.DOTALL)
+    pattern_res = [re.compile(regex, re.DOTALL) for regex in regexes]
+    for name in names:
+        norm_name = os.path.normcase(name)
+        if any_re.match(norm_name):
+            # A name may match more than one pattern.
+            for result, pattern_re in zip(results, pattern_res):
+                if pattern_re.match(norm_name):
+                    result.append(name)
+    return results
+
+
 TEMPLATE_RE = re.compile(ur"""
     \{\{
     ([^{}]+)
@@ -1053,12 +2503,38 @@ class Mixer(object):
 
     As well as interpreting the recipes, the mixer keeps
     track of the packs and loads them as needed.
+
+    Arguments --
+        loader (optional) -- used to fetch packs and maps;
+            default is to create a new Loader
+        compositing_pool (optional) -- a thread pool
+            (such as multiprocessing.pool.ThreadPool)
+            that composite resources will use to crop cells
+        render_cache (optional) -- a RenderCache in which
+            generated images are saved for reuse by later runs
+        encode_profile (optional) -- how generated images
+            are saved; see ENCODE_PROFILES
+        store_png (optional) -- if true, packs made by this mixer
+            store PNG files in their ZIP archives uncompressed
+        prefetch_workers (optional) -- how many packs `make` will
+            download at once before it starts mixing; 0 means packs
+            are downloaded one at a time when first needed
+        image_cache (optional) -- ImageCache shared by the packs
+            this mixer loads; by default it makes one
     """
-    def __init__(self, loader=None):
+    def __init__(self, loader=None, compositing_pool=None, render_cache=None,
+            encode_profile='release', store_png=False, prefetch_workers=4, image_cache=None):
         self.packs = {}
         self.atlas = Atlas()
-        self._atlas_cache = weakref.WeakValueDictionary()
+        self._atlas_cache = {}
+        self._pack_registry = {}
         self.loader = loader or Loader()
+        self.compositing_pool = compositing_pool
+        self.render_cache = render_cache
+        self.encode_profile = encode_profile
+        self.store_png = store_png
+        self.prefetch_workers = prefetch_workers
+        self.image_cache = ImageCache() if image_cache is None else image_cache
 
     def add_pack(self, name, pack):
         """Add this pack to the repertoire of this mixer.
@@ -1083,6 +2559,9 @@ class Mixer(object):
             A new pack object (subclass of PackBase).
         """
 
+        if self.prefetch_workers:
+            self.prefetch(recipe, base)
+
         # Check we have been supplied with the parameters we have declared.
         # Also unjumble any parameters marked for this odd treatment.
         # XXX this will affect uses of the same param in later calls. Bad?
@@ -1112,7 +2591,7 @@ class Mixer(object):
 
         label = self.expand_template(recipe['label'])
         desc = self.expand_template(recipe['desc'])
-        new_pack = RecipePack(label, desc)
+        new_pack = RecipePack(label, desc, store_png=self.store_png)
 
         mix = recipe['mix']
         if hasattr(mix, 'items'):
@@ -1124,6 +2603,43 @@ class Mixer(object):
                 new_pack.add_resource(res)
         return new_pack
 
+    def prefetch(self, recipe, base=None):
+        """Start downloading all the remote packs this recipe uses.
+
+        The downloads happen concurrently (see Loader.prefetch).
+        """
+        urls = []
+        for pack_spec in self.iter_pack_specs(recipe):
+            if isinstance(pack_spec, basestring) and pack_spec.startswith('$'):
+                pack = self.packs.get(pack_spec[1:])
+                if isinstance(pack, LazyPack) and not pack.pack:
+                    urls.append(pack.url)
+            elif pack_spec:
+                url = self.loader.get_url(pack_spec, base)
+                if url and url.startswith('http://'):
+                    urls.append(url)
+        self.loader.prefetch(urls, self.prefetch_workers)
+
+    def iter_pack_specs(self, recipe):
+        """Yield the specs of all the packs mentioned in this recipe."""
+        param_specs = (recipe.get('parameters') or {}).get('packs') or []
+        for param_spec in param_specs:
+            yield '$' + (param_spec if isinstance(param_spec, basestring) else param_spec['name'])
+        for pack_spec in (recipe.get('packs') or {}).values():
+            yield pack_spec
+        mix = recipe.get('mix') or []
+        if hasattr(mix, 'items'):
+            mix = [mix]
+        for ingredient in mix:
+            yield ingredient.get('pack')
+            for file_spec in ingredient.get('files') or []:
+                if hasattr(file_spec, 'items') and 'replace' in file_spec:
+                    specs = file_spec['replace']
+                    if hasattr(specs, 'items'):
+                        specs = [specs]
+                    for spec in specs:
+                        yield spec.get('pack')
+
     def expand_template(self, tpl):
         return TEMPLATE_RE.sub(self.expand_template_sub, tpl)
 
@@ -1140,13 +2656,16 @@ class Mixer(object):
         """Given a files spec, yield a sequence of resources.
 
         """
+        # All the wildcards are matched in one pass over the pack’s names.
+        globs = [file_spec for file_spec in resources_spec
+                if isinstance(file_spec, basestring) and '*' in file_spec]
+        if globs:
+            globbed = dict(zip(globs, match_globs(globs, src_pack.get_resource_names())))
         for file_spec in resources_spec:
             if isinstance(file_spec, basestring):
                 if '*' in file_spec:
                     # Its a wildcard: straight copy of all matching extant resources.
-                    res_names = src_pack.get_resource_names()
-                    res_names = fnmatch.filter(res_names, file_spec)
-                    for res_name in res_names:
+                    for res_name in globbed[file_spec]:
                         yield src_pack.get_resource(res_name)
                 else:
                     # The simplest case: a single named resource.
@@ -1161,7 +2680,7 @@ class Mixer(object):
                 try:
                     src_spec = file_spec.get('source', res_name)
                     if not isinstance(src_spec, basestring) and 'background' in src_spec:
-                        src_res = BlankResource(res_name, **src_spec)
+                        src_res = BlankResource(res_name, encode_profile=self.encode_profile, **src_spec)
                     else:
                         src_res = src_pack.get_resource(src_spec)
                 except NotInPack:
@@ -1171,7 +2690,9 @@ class Mixer(object):
                         raise
                 if 'replace' in file_spec:
                     src_map = self.get_map(src_pack.atlas, file_spec.get('map', src_res.name), base)
-                    res = CompositeResource(res_name, src_res, src_map)
+                    res = CompositeResource(res_name, src_res, src_map,
+                            pool=self.compositing_pool, render_cache=self.render_cache,
+                            encode_profile=self.encode_profile)
                     specs = file_spec['replace']
                     if hasattr(specs, 'items'):
                         specs = [specs]
@@ -1187,7 +2708,8 @@ class Mixer(object):
                     res = src_res
                 elif 'pack_icon' in file_spec:
                     src_map = self.get_map(src_pack.atlas, file_spec.get('map', src_res.name), base)
-                    res = PackIconResource(src_res, src_map, file_spec['pack_icon']['cells'])
+                    res = PackIconResource(src_res, src_map, file_spec['pack_icon']['cells'],
+                            render_cache=self.render_cache, encode_profile=self.encode_profile)
                 else:
                     res = RenamedResource(res_name, src_res)
                 yield res
@@ -1226,7 +2748,8 @@ class Mixer(object):
                 Must be a file or http URL.
 
         Returns --
-            A pack object
+            A pack object. Specs that resolve to the same URL
+            with the same maps get the same pack object.
 
         Raises --
             UnknownPack -- when the specified pack does not exist.
@@ -1240,6 +2763,28 @@ class Mixer(object):
                 raise UnknownPack(pack_spec)
             return result
 
+        key = self._get_pack_key(pack_spec, base)
+        pack = key and self._pack_registry.get(key)
+        if not pack:
+            pack = self._make_pack(pack_spec, base)
+            if key:
+                self._pack_registry[key] = pack
+        return pack
+
+    def _get_pack_key(self, pack_spec, base):
+        """Key identifying the pack in the registry, or None if it has no URL."""
+        url = self.loader.get_url(pack_spec, base)
+        if not url:
+            return None
+        if not hasattr(pack_spec, 'get'):
+            return url, None
+        atlas_specs = [pack_spec.get('maps'), pack_spec.get('unjumble')]
+        if not any(atlas_specs):
+            return url, None
+        # Map specs may be relative references, so include the base.
+        return url, json.dumps([atlas_specs, base], sort_keys=True)
+
+    def _make_pack(self, pack_spec, base):
         atlas_spec = hasattr(pack_spec, 'get') and pack_spec.get('maps', pack_spec.get('unjumble'))
         atlas = self.get_atlas(atlas_spec, base)
 
@@ -1256,7 +2801,7 @@ class Mixer(object):
         # Various ways of decoding the pack spec.
         url = self.loader.get_url(pack_spec, base)
         if url and url.startswith('http://'):
-            return LazyPack(self.loader, url, atlas)
+            return LazyPack(self.loader, url, atlas, self.image_cache)
 
         try:
             if url:
@@ -1266,13 +2811,13 @@ class Mixer(object):
         except CouldNotLoad, e:
             raise UnknownPack(pack_spec, e)
         except DudeItsADirectory, e:
-            return SourcePack(e.path, atlas)
+            return SourcePack(e.path, atlas, self.image_cache)
 
         # If we have data, unpack it.
         if not strm:
             raise UnknownPack(pack_spec)
 
-        return SourcePack(strm, atlas)
+        return SourcePack(strm, atlas, self.image_cache)
 
     def make_unjumbled_pack(self, pack, atlas):
         """Make an unjumbled copy of this pack using this atlas.
@@ -1281,21 +2826,25 @@ class Mixer(object):
         create a new pack that rearranges the files to conform
         to texturepack conventions.
         """
-        pack_names = list(pack.get_resource_names())
+        # Index the available names by their last component.
+        # Each is used at most once, earliest in the pack first.
+        names_by_nick = {}
+        for available_name in pack.get_resource_names():
+            nick = available_name.split('/')[-1]
+            names_by_nick.setdefault(nick, deque()).append(available_name)
+
         new_label = pack.label
         new_desc = pack.desc
-        new_pack = RecipePack(new_label, new_desc, atlas=atlas)
+        new_pack = RecipePack(new_label, new_desc, atlas=atlas, store_png=self.store_png)
         for desired_name in atlas.get_map_names():
             nick = desired_name.split('/')[-1]
-            slash_nick = '/' + nick
-            for i, available_name in enumerate(pack_names):
-                if available_name == nick or available_name.endswith(slash_nick):
-                    res = pack.get_resource(available_name)
-                    if desired_name != available_name:
-                        res = RenamedResource(desired_name, res)
-                    new_pack.add_resource(res)
-                    del pack_names[i]
-                    break
+            candidates = names_by_nick.get(nick)
+            if candidates:
+                available_name = candidates.popleft()
+                res = pack.get_resource(available_name)
+                if desired_name != available_name:
+                    res = RenamedResource(desired_name, res)
+                new_pack.add_resource(res)
         return new_pack
 
     def get_map(self, atlas, spec, base):
@@ -1320,12 +2869,35 @@ class Mixer(object):
         resource names to map specs,
         or is a dictionary with a single member
         'file' specifying a file to read the atlas from.
+
+        Atlases read from a file or URL are remembered by their
+        resolved URL, so each file (and any chain of files it refers to)
+        is built once per mixer. The atlas returned in that case
+        is shared and should not be changed.
         """
-        if not atlas:
-            atlas = Atlas()
+        if isinstance(atlas_spec, basestring):
+            atlas_spec = {'href': atlas_spec}
+        url = hasattr(atlas_spec, 'items') and self.loader.get_url(atlas_spec, base)
+        if not url:
+            return self._build_atlas(atlas_spec, base, Atlas() if atlas is None else atlas)
+
+        shared = self._atlas_cache.get(url)
+        if not shared:
+            try:
+                shared = self._build_atlas(atlas_spec, base, Atlas())
+            except NotInAtlas:
+                # It refers to maps defined alongside it, so cannot be built on its own.
+                if atlas is None:
+                    raise
+                return self._build_atlas(atlas_spec, base, atlas)
+            self._atlas_cache[url] = shared
+        if atlas is None:
+            return shared
+        atlas.maps.update(shared.maps)
+        return atlas
+
+    def _build_atlas(self, atlas_spec, base, atlas):
         if atlas_spec:
-            if isinstance(atlas_spec, basestring):
-                atlas_spec = {'href': atlas_spec}
             atlas_base = (base
                 if not hasattr(atlas_spec, 'items')
                 else {'file': resolve_file_path(atlas_spec['file'], base)}
@@ -13,7 +13,13 @@ import httplib2
 import re
 from BeautifulSoup import BeautifulSoup
 import json
-from urlparse import urljoin
+import hashlib
+from collections import OrderedDict
+import time
+import tempfile
+import threading
+from multiprocessing.pool import ThreadPool
+from urlparse import urljoin, urlsplit
 
 # Unwrapper functions take a URL, response, and body
 # (these being the result of a request for that URL)
@@ -40,6 +46,41 @@ def unwrapper_for(url_pattern, follow_redirects=True):
     return func_wrapper
 
 
+# Scanning for the parts of pages that unwrappers need.
+# Parsing a whole forum page with BeautifulSoup is slow,
+# so these find what is wanted by looking for tags in the text,
+# stopping as soon as it is found. They return None if they can’t
+# find it, in which case the unwrapper parses the whole page instead.
+
+def scan_element(body, tag, class_name):
+    """Return the markup of the first element with this tag and class, or None.
+
+    Elements of the same type inside it are counted so that
+    the markup returned ends with its own end tag.
+    """
+    start_re = re.compile(r"""<{0}\b[^>]*\bclass\s*=\s*["'][^"']*(?<![\w-]){1}(?![\w-])""".format(
+            tag, re.escape(class_name)), re.IGNORECASE)
+    m = start_re.search(body)
+    if not m:
+        return None
+    depth = 1
+    for tag_m in re.compile(r'<(/?){0}\b'.format(tag), re.IGNORECASE).finditer(body, m.end()):
+        depth += -1 if tag_m.group(1) else 1
+        if depth == 0:
+            end = body.find('>', tag_m.end())
+            return body[m.start():end + 1] if end >= 0 else None
+    return None
+
+SCRIPT_RE = re.compile(r'<script\b([^>]*)>(.*?)</script\s*>', re.IGNORECASE | re.DOTALL)
+ATTR_RE = re.compile(r"""(\w+)\s*=\s*(?:"([^"]*)"|'([^']*)'|([^\s>]+))""")
+
+def scan_scripts(body):
+    """Generate (attrs, text) pairs for the SCRIPT elements in this page, in order."""
+    for m in SCRIPT_RE.finditer(body):
+        attrs = dict((name.lower(), v1 or v2 or v3) for (name, v1, v2, v3) in ATTR_RE.findall(m.group(1)))
+        yield attrs, m.group(2)
+
+
 ADFLY_RE = re.compile(ur"""
     function \s close_bar\(\) \s \{ \s+
     self\.location \s = \s '(?P<next>[^']*)'; \s+
@@ -70,7 +111,7 @@ def unwrap_planetminecraft(url, resp, body):
         'home': resp['content-location'],
         'download': resp['content-location'],
     }
-    soup = BeautifulSoup(body)
+    soup = BeautifulSoup(scan_element(body, 'div', 'resource-share') or body)
     table_elt = soup.first('div', 'resource-share').table
     for tr_elt in table_elt.findAll('tr'):
         a_elt = tr_elt.td.a
@@ -113,7 +154,8 @@ def unwrap_minecraftforum(url, resp, body):
     }
 
     # It might also have clues as to where the downloads are.
-    soup = BeautifulSoup(body)
+    # The first post is the one by the author of the pack.
+    soup = BeautifulSoup(scan_element(body, 'div', 'entry-content') or body)
     post_elt = soup.first('div', 'entry-content')
 
     best_href = None
@@ -172,21 +214,13 @@ def unwrap_mediafire(url, resp, body):
         'download': url,
     }
 
-    soup = BeautifulSoup(body)
-
     # The first of three codes needed to generate the next URL.
     secret_qk = url.split('?', 1)[1]
 
     # The JavaScript calls a function whose name is randomized.
     # So our first job is to find the name of the function.
-    for elt in soup.body.findAll('script', type='text/javascript', language=None):
-        s = elt.string
-        s = s and s.strip()
-        if s:
-            m = MEDIAFIRE_CALL_RE.search(s)
-            if m:
-                secret_func = m.group(1)
-                break
+    # The second job is to find the script with the other codes in.
+    secret_func, pkr_script = scan_mediafire_scripts(body) or soup_mediafire_scripts(body)
 
     # That function has within it some 'encrypted' code
     # which in turn contains the third key.
@@ -201,21 +235,19 @@ def unwrap_mediafire(url, resp, body):
         eval\(\w+\);
         """ % secret_func, re.VERBOSE)
 
-    for elt in soup.body.findAll('script', type='text/JavaScript', language='JavaScript'): # lol capitalization
-        m = MEDIAFIRE_PKR_RE.search(elt.string)
-        if m:
-            # This is the second code needed to get the next URL.
-            secret_pKr = m.group(1)
+    if pkr_script:
+        m = MEDIAFIRE_PKR_RE.search(pkr_script)
+        # This is the second code needed to get the next URL.
+        secret_pKr = m.group(1)
 
-            # Now to find the 'encrypted' function and pull the third code out of it.
-            m = FUNC_PAT.search(elt.string)
-            if m:
-                plaintext = mediafire_decode(m.group('cyphertext'), m.group('count'), m.group('key'))
+        # Now to find the 'encrypted' function and pull the third code out of it.
+        m = FUNC_PAT.search(pkr_script)
+        if m:
+            plaintext = mediafire_decode(m.group('cyphertext'), m.group('count'), m.group('key'))
 
-                # Now hoik the third code out of the plaintext.
-                m = MEDIAFIRE_CALL2_RE.match(plaintext)
-                secret_pk1 = m.group(1)
-            break
+            # Now hoik the third code out of the plaintext.
+            m = MEDIAFIRE_CALL2_RE.match(plaintext)
+            secret_pk1 = m.group(1)
 
     # The next URL is also on Mediafire -- this is the dynamically generated page
     # that is loaded in to an invisible IFRAME.
@@ -223,6 +255,47 @@ def unwrap_mediafire(url, resp, body):
                 % (secret_qk, secret_pk1, secret_pKr))
     return urls
 
+def scan_mediafire_scripts(body):
+    """Find the name of the secret function and the script containing the pKr code.
+
+    Returns --
+        secret_func, pkr_script; or None if they were not both found.
+    """
+    secret_func = pkr_script = None
+    for attrs, text in scan_scripts(body):
+        if secret_func is None and attrs.get('type') == 'text/javascript' and 'language' not in attrs:
+            m = MEDIAFIRE_CALL_RE.search(text.strip())
+            if m:
+                secret_func = m.group(1)
+        elif (pkr_script is None and attrs.get('type') == 'text/JavaScript' # lol capitalization
+                and attrs.get('language') == 'JavaScript' and MEDIAFIRE_PKR_RE.search(text)):
+            pkr_script = text
+        if secret_func and pkr_script:
+            return secret_func, pkr_script
+    return None
+
+def soup_mediafire_scripts(body):
+    """As scan_mediafire_scripts, but by parsing the page with BeautifulSoup.
+
+    Returns --
+        secret_func, pkr_script (either may be None)
+    """
+    soup = BeautifulSoup(body)
+    secret_func = pkr_script = None
+    for elt in soup.body.findAll('script', type='text/javascript', language=None):
+        s = elt.string
+        s = s and s.strip()
+        if s:
+            m = MEDIAFIRE_CALL_RE.search(s)
+            if m:
+                secret_func = m.group(1)
+                break
+    for elt in soup.body.findAll('script', type='text/JavaScript', language='JavaScript'): # lol capitalization
+        if MEDIAFIRE_PKR_RE.search(elt.string):
+            pkr_script = elt.string
+            break
+    return secret_func, pkr_script
+
 def mediafire_decode(cyphertext, count, key):
     """Mediafire use a simple cypher to obscure some codes embedded in their HTML.
 
@@ -325,16 +398,134 @@ COOKIE_EXPIRES_RE = re.compile("""
     [;,]?
     """, re.VERBOSE)
 
+class UnwrapCache(object):
+    """A directory of the results of unwrapping URLs, named by a hash of the starting URL.
+
+    Arguments --
+        dir_path -- where to keep the results
+        ttl (optional) -- how many seconds a result is used for
+            before the URL is unwrapped again (default one day)
+        refresh (optional) -- if true, ignore saved results
+            (but still save new ones)
+    """
+    version = 1
+
+    def __init__(self, dir_path, ttl=24 * 60 * 60, refresh=False):
+        self.dir_path = dir_path
+        self.ttl = ttl
+        self.refresh = refresh
+        if not os.path.isdir(dir_path):
+            os.makedirs(dir_path)
+
+    def _get_file_path(self, url):
+        key = hashlib.sha1('{0}\n{1}'.format(self.version, url))
+        return os.path.join(self.dir_path, key.hexdigest() + '.json')
+
+    def get(self, url):
+        """Return the saved result of unwrapping this URL, or None if there is none still fresh."""
+        if self.refresh:
+            return None
+        try:
+            with open(self._get_file_path(url), 'rb') as strm:
+                entry = json.load(strm)
+        except (IOError, ValueError):
+            return None # Not in the cache, or unreadable.
+        if entry.get('url') != url or time.time() - entry.get('time', 0) > self.ttl:
+            return None
+        # JSON gives us unicode strings; the URLs were byte strings.
+        return dict((str(key), value.encode('UTF-8')) for key, value in entry['result'].items())
+
+    def put(self, url, result):
+        """Save the result of unwrapping this URL."""
+        from mixer import replace_file # Not at the top: mixer imports this module.
+
+        file_path = self._get_file_path(url)
+        # Threads in unwrap_many share a process ID, so the temp file needs a unique name.
+        fd, temp_path = tempfile.mkstemp(dir=os.path.dirname(file_path))
+        with os.fdopen(fd, 'wb') as strm:
+            json.dump({'url': url, 'time': time.time(), 'result': result}, strm)
+        replace_file(temp_path, file_path)
+
+
+class HostLimiter(object):
+    """Limits how many requests are made to each host at once."""
+    def __init__(self, per_host):
+        self.per_host = per_host
+        self._semaphores = {}
+        self._lock = threading.Lock()
+
+    def get_semaphore(self, url):
+        """Return the semaphore to hold while requesting this URL."""
+        host = urlsplit(url).netloc.lower()
+        with self._lock:
+            semaphore = self._semaphores.get(host)
+            if semaphore is None:
+                semaphore = self._semaphores[host] = threading.Semaphore(self.per_host)
+        return semaphore
+
+
 class Unwrapper(object):
     """Device for peeling back layers of redirection web sites to get the actual download link.
 
-    The `unwrap` methodis used to attempt to find download etc. URLs.
+    The `unwrap` methodis used to attempt to find download etc. URLs,
+    and `unwrap_many` to do this for several URLs at once.
 
+    Arguments --
+        http (optional) -- httplib2.Http or similar to make requests with;
+            if there is none, each thread gets an httplib2.Http of its own
+        cache (optional) -- UnwrapCache for remembering results between runs
     """
-    def __init__(self, http=None):
-        self.http = http or httplib2.Http()
+    def __init__(self, http=None, cache=None):
+        self._http = http
+        self._local = threading.local()
+        self.cache = cache
+
+    @property
+    def http(self):
+        if self._http:
+            return self._http
+        http = getattr(self._local, 'http', None)
+        if http is None:
+            http = self._local.http = httplib2.Http()
+        return http
+
+    def unwrap_many(self, urls, workers=8, per_host=2, until=None, refresh=False):
+        """Unwrap these URLs concurrently.
+
+        Arguments --
+            urls -- starting URLs, as for unwrap
+            workers (optional) -- how many URLs to work on at once
+            per_host (optional) -- how many requests to make
+                to any one host at once
+            until, refresh (optional) -- as for unwrap
 
-    def unwrap(self, url, until=None):
+        Returns --
+            An iterator of (url, result) pairs, in the order
+            they are finished rather than the order of urls.
+            If unwrapping a URL raised an exception,
+            the exception is in place of its result.
+
+        Each URL has its own cookie jar, as for unwrap.
+        The http object (if supplied) must be safe to share
+        between threads, as texturepacker.HttpClient is.
+        """
+        urls = list(OrderedDict.fromkeys(urls))
+        if not urls:
+            return
+        host_limiter = HostLimiter(per_host)
+        def unwrap_one(url):
+            try:
+                return url, self._unwrap(url, until, refresh, host_limiter)
+            except Exception, e:
+                return url, e
+        pool = ThreadPool(min(workers, len(urls)))
+        try:
+            for url_result in pool.imap_unordered(unwrap_one, urls):
+                yield url_result
+        finally:
+            pool.terminate()
+
+    def unwrap(self, url, until=None, refresh=False):
         """Try to find actual download and forum URLs, starting with this one.
 
         Arguments --
@@ -360,10 +551,21 @@ class Unwrapper(object):
 
         This may make one or more HTTP requests, and will consume
         memory as it holds the intermediate resources for examination.
+        If there is a cache, a result saved there is returned instead
+        unless `refresh` is true; only complete results are saved.
         """
+        return self._unwrap(url, until, refresh)
+
+    def _unwrap(self, url, until=None, refresh=False, host_limiter=None):
         if until:
             until = set(until)
 
+        if self.cache and not refresh:
+            result = self.cache.get(url)
+            if result is not None:
+                return result
+        start_url = url
+
         cookie_jar = {}
         queue = [url]
         result = {}
@@ -388,7 +590,11 @@ class Unwrapper(object):
                         self.http.follow_redirects = func.follow_redirects if hasattr(func, 'follow_redirects') else True
                         if cookie_jar:
                             headers['cookie'] = ';'.join('%s=%s' % (key, val) for (key, val) in cookie_jar.items())
-                        resp, body = self.http.request(url, headers=headers)
+                        if host_limiter:
+                            with host_limiter.get_semaphore(url):
+                                resp, body = self.http.request(url, headers=headers)
+                        else:
+                            resp, body = self.http.request(url, headers=headers)
                         if 'set-cookie' in resp:
                             # Highly simplified cookie-wrangling—we assume we just want to copy all of them.
                             cookies_line = COOKIE_EXPIRES_RE.sub('', resp['set-cookie'])
@@ -417,6 +623,8 @@ class Unwrapper(object):
                 break
             if 'next' in result:
                 queue.append(result.pop('next'))
+        if self.cache and 'final' in result:
+            self.cache.put(start_url, result)
         return result
 
 default_unwrapper = None
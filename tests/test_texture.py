@@ -16,12 +16,117 @@ from texturepacker import *
 import texturepacker.unwrapper
 
 from datetime import datetime, timedelta
-from zipfile import ZipFile, ZipInfo, ZIP_DEFLATED
+from zipfile import ZipFile, ZipInfo, ZIP_DEFLATED, ZIP_STORED, ZIP64_LIMIT, LargeZipFile
 from StringIO import StringIO
 from base64 import b64encode
+from multiprocessing.pool import ThreadPool
 import shutil
+import tempfile
+import imp
 import httplib2
 import json
+import threading
+import fnmatch
+import time
+import re
+import hashlib
+import socket
+from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
+from SocketServer import ThreadingMixIn
+
+
+class StandInHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1' # So connections are kept alive.
+    timeout = 10
+
+    def setup(self):
+        BaseHTTPRequestHandler.setup(self)
+        self.server.connections.append(self.connection)
+
+    def do_GET(self):
+        self.server.requests.append(self.path)
+        self.server.clients.append(self.client_address)
+        try:
+            content_type, body = self.server.resources[self.path]
+        except KeyError:
+            self.send_error(404)
+            return
+        etag = self.server.etags.get(self.path)
+        if etag and self.headers.get('If-None-Match') == etag:
+            self.send_response(304)
+            self.send_header('ETag', etag)
+            self.end_headers()
+            return
+        self.server.ranges.append(self.headers.get('Range'))
+        byte_range = self.get_range(len(body))
+        if_range = self.headers.get('If-Range')
+        if byte_range and (not if_range or if_range == etag and not etag.startswith('W/')):
+            first, last = byte_range
+            self.send_response(206)
+            self.send_header('Content-Range', 'bytes {0}-{1}/{2}'.format(first, last, len(body)))
+            body = body[first:last + 1]
+        else:
+            self.send_response(200)
+        self.send_header('Content-Type', content_type)
+        if etag:
+            self.send_header('ETag', etag)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def get_range(self, size):
+        """Return (first, last) from the Range header, if the server supports them."""
+        m = re.match(r'bytes=(\d*)-(\d*)$', self.headers.get('Range') or '')
+        if not self.server.accept_ranges or not m:
+            return None
+        if not m.group(1):
+            return max(size - int(m.group(2)), 0), size - 1
+        return int(m.group(1)), min(int(m.group(2) or size - 1), size - 1)
+
+    def log_message(self, *args):
+        pass
+
+class StandInServer(ThreadingMixIn, HTTPServer):
+    """An HTTP server on localhost for tests to download from.
+
+    Add resources by path to `resources`;
+    paths requested are appended to `requests`,
+    and the clients’ addresses to `clients`.
+    Resources added with an ETag can be revalidated.
+    If accept_ranges is true, Range headers are honoured;
+    they are appended to `ranges` (None if there was none).
+    """
+    daemon_threads = True
+
+    def __init__(self, accept_ranges=False):
+        HTTPServer.__init__(self, ('127.0.0.1', 0), StandInHandler)
+        self.accept_ranges = accept_ranges
+        self.resources = {}
+        self.requests = []
+        self.ranges = []
+        self.clients = []
+        self.connections = []
+        self.etags = {}
+        self.thread = threading.Thread(target=self.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def add(self, path, content_type, body, etag=None):
+        self.resources[path] = content_type, body
+        if etag:
+            self.etags[path] = etag
+
+    def url(self, path):
+        return 'http://127.0.0.1:{0}{1}'.format(self.server_port, path)
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+        for conn in self.connections:
+            try:
+                conn.shutdown(socket.SHUT_RDWR)
+            except socket.error:
+                pass # Already closed by the client.
 
 
 class TestCase(unittest.TestCase):
@@ -37,6 +142,19 @@ class TestCase(unittest.TestCase):
             os.mkdir(cache_dir)
         set_http_cache(cache_dir)
 
+    def start_server(self, **kwargs):
+        """Start a StandInServer, with a private HTTP cache removed afterwards.
+
+        The server’s URLs include its port, so a shared cache
+        would collect files from every run.
+        """
+        cache_dir = tempfile.mkdtemp(dir=self.test_dir)
+        self.addCleanup(shutil.rmtree, cache_dir, True)
+        set_http_cache(cache_dir)
+        server = StandInServer(**kwargs)
+        self.addCleanup(server.stop)
+        return server
+
     def get_data(self, file_name):
         with open(os.path.join(self.data_dir, file_name), 'rb') as strm:
             bytes = strm.read()
@@ -64,6 +182,8 @@ class TestCase(unittest.TestCase):
             bytes2 = bytes2.get_bytes()
         im2 = Image.open(StringIO(bytes2))
         self.assertEqual(im1.size, im2.size)
+        # Outputs may be paletted or not; compare the colours they represent.
+        im1, im2 = im1.convert('RGBA'), im2.convert('RGBA')
         w, h = im1.size
         for i, (b1, b2) in enumerate(zip(im1.getdata(), im2.getdata())):
             self.assertEqual(b1, b2, '{msg}Pixels at ({x}, {y}) differ: {b1!r} != {b2!r}'.format(
@@ -134,6 +254,49 @@ class SourcePackTests(TestCase):
         pack = SourcePack(file_path, Atlas())
         self.check_pack_is_sign_pack(pack)
 
+    def test_directory_pack_index(self):
+        pack = self.create_sign_directory()
+        self.assertEqual(['item/sign.png', 'pack.txt'], list(pack.get_resource_names()))
+        self.assertRaises(NotInPack, pack.get_resource, 'item/door.png')
+
+        # Changes are noticed.
+        os.mkdir(os.path.join(self.dir_pack_path, 'terrain'))
+        with open(os.path.join(self.dir_pack_path, 'terrain', 'door.png'), 'wb') as strm:
+            strm.write(self.get_data('sign.png'))
+        os.remove(os.path.join(self.dir_pack_path, 'item', 'sign.png'))
+        os.rmdir(os.path.join(self.dir_pack_path, 'item'))
+        self.touch_dir('', 'terrain')
+
+        self.assertEqual(['pack.txt', 'terrain/door.png'], list(pack.get_resource_names()))
+        self.assertEqual('terrain/door.png', pack.get_resource('terrain/door.png').name)
+
+    def test_directory_pack_index_only_lists_changed_dirs(self):
+        pack = self.create_sign_directory()
+        list(pack.get_resource_names())
+        with open(os.path.join(self.dir_pack_path, 'item', 'door.png'), 'wb') as strm:
+            strm.write(self.get_data('sign.png'))
+        self.touch_dir('item')
+
+        with patch('os.listdir', side_effect=os.listdir) as mock_listdir:
+            self.assertEqual(['item/door.png', 'item/sign.png', 'pack.txt'],
+                    list(pack.get_resource_names()))
+        self.assertEqual([os.path.join(self.dir_pack_path, 'item')],
+                [args[0] for args, kwargs in mock_listdir.call_args_list])
+
+    def test_directory_pack_last_modified(self):
+        pack = self.create_sign_directory()
+        t = int(time.time()) - 3600
+        os.utime(os.path.join(self.dir_pack_path, 'pack.txt'), (t, t))
+        os.utime(os.path.join(self.dir_pack_path, 'item', 'sign.png'), (t - 60, t - 60))
+        self.assertEqual(datetime.fromtimestamp(t), pack.get_last_modified())
+
+    def touch_dir(self, *subdirs):
+        # Make sure the change in modification time is noticed,
+        # however coarse the file system’s timestamps.
+        t = time.time() + 10
+        for subdir in subdirs:
+            os.utime(os.path.join(self.dir_pack_path, subdir), (t, t))
+
     def create_sign_directory(self):
         # Create dir from scratch with contesnts of a pack.
         os.mkdir(self.dir_pack_path)
@@ -147,6 +310,67 @@ class SourcePackTests(TestCase):
         return pack
 
 
+class ImageCacheTests(TestCase):
+    def test_lru_eviction(self):
+        cache = ImageCache(max_bytes=2 * 16 * 16 * 4)
+        ims = [Image.new('RGBA', (16, 16)) for i in range(3)]
+        cache.put('a', ims[0])
+        cache.put('b', ims[1])
+        self.assertTrue(cache.get('a') is ims[0]) # Now b is least recently used.
+        cache.put('c', ims[2])
+
+        self.assertTrue(cache.get('b') is None)
+        self.assertTrue(cache.get('a') is ims[0])
+        self.assertTrue(cache.get('c') is ims[2])
+        self.assertEqual({'hits': 3, 'misses': 1, 'evictions': 1, 'count': 2, 'bytes': 2048},
+                cache.get_stats())
+
+    def test_too_big_evicts_everything_else(self):
+        cache = ImageCache(max_bytes=100)
+        small, big = Image.new('L', (8, 8)), Image.new('RGBA', (16, 16))
+        cache.put('a', small)
+        cache.put('b', big)
+        self.assertTrue(cache.get('b') is big)
+        self.assertTrue(cache.get('a') is None)
+
+        cache.put('a', small)
+        self.assertTrue(cache.get('a') is small)
+        self.assertTrue(cache.get('b') is None)
+
+    def test_source_resource_bytes_not_kept(self):
+        pack = SourcePack(StringIO(self.make_source_pack_bytes()), Atlas())
+        res = pack.get_resource('item/sign.png')
+        with patch.object(pack, 'get_resource_bytes', return_value='sign') as mock_get_bytes:
+            self.assertEqual('sign', res.get_bytes())
+            self.assertEqual('sign', res.get_bytes())
+        self.assertEqual(2, mock_get_bytes.call_count)
+
+    def test_source_pack_keeps_decoded_images(self):
+        cache = ImageCache()
+        pack2 = SourcePack(StringIO(self.make_source_pack_bytes()), Atlas(), cache)
+        im1 = pack2.get_resource('item/sign.png').get_image()
+        # Even once the resource has been dropped, its image is kept.
+        pack2.loaded_resources.clear()
+        im2 = pack2.get_resource('item/sign.png').get_image()
+        self.assertTrue(im1 is im2)
+        self.assertEqual('RGBA', im1.mode)
+        self.assertEqual((1, 1), (cache.hits, cache.misses))
+
+    def test_shared_cache_keeps_packs_apart(self):
+        cache = ImageCache()
+        pack1 = SourcePack(StringIO(self.make_source_pack_bytes()), Atlas(), cache)
+        pack2 = SourcePack(StringIO(self.make_source_pack_bytes()), Atlas(), cache)
+        im1 = pack1.get_resource('item/sign.png').get_image()
+        im2 = pack2.get_resource('item/sign.png').get_image()
+        self.assertFalse(im1 is im2)
+        self.assertEqual(2, cache.get_stats()['count'])
+
+    def make_source_pack_bytes(self):
+        strm = StringIO()
+        self.write_pack_contents(strm, 'Sign pack', 'Just a test', {'item/sign.png': ('sign.png', None)})
+        return strm.getvalue()
+
+
 class RecipePackTests(TestCase):
     def test_pack_txt_from_init(self):
         pack = RecipePack(u'Test pack', u'It’s testy')
@@ -188,6 +412,144 @@ class RecipePackTests(TestCase):
             except KeyError:
                 pass
 
+    def sample_recipe_pack(self):
+        simple_map = GridMap((32, 32), (16, 16), ['a', 'b', 'c', 'd'])
+        pack_ab = self.make_source_pack('AB', 'Has A and B', {'a.png': ('a.png', simple_map), 'b.png': ('b.png', simple_map)})
+        new_pack = RecipePack(u'Composite pack', u'It’s composite')
+        new_pack.add_resource(pack_ab.get_resource('a.png'))
+        res = CompositeResource('ab.png', pack_ab.get_resource('b.png'), simple_map)
+        res.replace(pack_ab.get_resource('a.png'), simple_map, ['a', 'd'])
+        new_pack.add_resource(res)
+        new_pack.add_resource(TextResource('doc/news.txt', 'This is a news file.'))
+        return new_pack
+
+    def check_written_with_workers(self, **kwargs):
+        new_pack = self.sample_recipe_pack()
+        strm1 = StringIO()
+        new_pack.write_to(strm1)
+        strm2 = StringIO()
+        new_pack.write_to(strm2, **kwargs)
+
+        strm1.seek(0)
+        strm2.seek(0)
+        with ZipFile(strm1, 'r') as zip1:
+            with ZipFile(strm2, 'r') as zip2:
+                self.assertEqual(['a.png', 'ab.png', 'doc/news.txt', 'pack.txt'], zip2.namelist())
+                self.assertTrue(zip2.testzip() is None)
+                for name in zip1.namelist():
+                    self.assertEqual(zip1.read(name), zip2.read(name))
+                    self.assertEqual(zip1.getinfo(name).compress_size, zip2.getinfo(name).compress_size)
+
+    def test_zip_copies_source_entries_raw(self):
+        strm = StringIO()
+        with ZipFile(strm, 'w', ZIP_DEFLATED) as zip:
+            zip.writestr('a.png', self.get_data('a.png'))
+            zip.writestr('doc/news.txt', 'Extra! Extra!')
+        strm.seek(0)
+        pack_a = SourcePack(strm, Atlas())
+        new_pack = RecipePack(u'Copy pack', u'It’s a copy')
+        new_pack.add_resource(pack_a.get_resource('a.png'))
+        new_pack.add_resource(RenamedResource('b.png', pack_a.get_resource('a.png')))
+
+        with patch('texturepacker.mixer.deflate_entry') as mock_deflate:
+            mock_deflate.side_effect = deflate_entry
+            strm2 = StringIO()
+            new_pack.write_to(strm2)
+        self.assertEqual(1, mock_deflate.call_count) # Only pack.txt needed compressing.
+
+        strm2.seek(0)
+        with ZipFile(strm2, 'r') as zip2:
+            self.assertTrue(zip2.testzip() is None)
+            self.assertEqual(self.get_data('a.png'), zip2.read('a.png'))
+            self.assertEqual(self.get_data('a.png'), zip2.read('b.png'))
+            self.assertEqual(pack_a.zip.getinfo('a.png').compress_size, zip2.getinfo('b.png').compress_size)
+
+    def test_zip_entry_too_big_without_zip64(self):
+        class HugeData(str):
+            def __len__(self):
+                return ZIP64_LIMIT + 1
+        strm = StringIO()
+        with ZipFile(strm, 'w') as zip:
+            zip.writestr('pack.txt', 'Huge\nHuge pack')
+        data = strm.getvalue()
+        with ZipFile(strm, 'a', allowZip64=False) as zip:
+            with self.assertRaises(LargeZipFile):
+                write_zip_entry(zip, 'huge.dat', (ZIP_DEFLATED, 0, 10, HugeData('not really')))
+            self.assertEqual(['pack.txt'], zip.namelist())
+            self.assertFalse(zip._didModify)
+        self.assertEqual(data, strm.getvalue())
+
+    def test_zip_store_png(self):
+        new_pack = self.sample_recipe_pack()
+        new_pack.store_png = True
+        strm = StringIO()
+        new_pack.write_to(strm)
+
+        strm.seek(0)
+        with ZipFile(strm, 'r') as zip:
+            self.assertTrue(zip.testzip() is None)
+            self.assertEqual(ZIP_STORED, zip.getinfo('ab.png').compress_type)
+            self.assertEqual(ZIP_DEFLATED, zip.getinfo('doc/news.txt').compress_type)
+
+    def test_zip_reuses_unchanged_entries(self):
+        old_pack = self.sample_recipe_pack()
+        file_path = os.path.join(self.test_dir, 'incremental.zip')
+        old_pack.write_to(file_path)
+        manifest = old_pack.get_manifest()
+        self.assertEqual(set(['a.png', 'ab.png', 'doc/news.txt', 'pack.txt']), set(manifest))
+
+        # Same recipe except for the news.
+        new_pack = self.sample_recipe_pack()
+        new_pack.add_resource(TextResource('doc/news.txt', 'This is newer news.'))
+        previous_pack = SourcePack(file_path, Atlas())
+        strm = StringIO()
+        new_pack.write_to(strm, previous_pack=previous_pack, previous_manifest=manifest)
+
+        self.assertTrue(new_pack.get_resource('ab.png')._image is None) # Was not composited.
+        strm.seek(0)
+        with ZipFile(strm, 'r') as zip:
+            self.assertTrue(zip.testzip() is None)
+            self.assertEqual(previous_pack.get_resource_bytes('ab.png'), zip.read('ab.png'))
+            self.assertEqual('This is newer news.', zip.read('doc/news.txt'))
+
+    def test_zip_not_reused_when_compression_changes(self):
+        old_pack = self.sample_recipe_pack()
+        file_path = os.path.join(self.test_dir, 'incremental.zip')
+        old_pack.write_to(file_path)
+        manifest = old_pack.get_manifest()
+
+        new_pack = self.sample_recipe_pack()
+        new_pack.store_png = True
+        previous_pack = SourcePack(file_path, Atlas())
+        strm = StringIO()
+        new_pack.write_to(strm, previous_pack=previous_pack, previous_manifest=manifest)
+
+        strm.seek(0)
+        with ZipFile(strm, 'r') as zip:
+            self.assertEqual(ZIP_STORED, zip.getinfo('ab.png').compress_type)
+            self.assertEqual(ZIP_DEFLATED, zip.getinfo('doc/news.txt').compress_type)
+        self.assertEqual(manifest['doc/news.txt'], new_pack.get_manifest()['doc/news.txt'])
+
+    def test_source_entries_fingerprinted_without_reading(self):
+        def zipped_pack(png_name):
+            strm = StringIO()
+            with ZipFile(strm, 'w', ZIP_DEFLATED) as zip:
+                zip.writestr('a.png', self.get_data(png_name))
+            strm.seek(0)
+            return SourcePack(strm, Atlas())
+        pack_a, pack_b, pack_a2 = zipped_pack('a.png'), zipped_pack('b.png'), zipped_pack('a.png')
+
+        with patch.object(SourcePack, 'get_resource_bytes', side_effect=AssertionError('decompressed')):
+            fingerprint = pack_a.get_resource('a.png').get_fingerprint()
+            self.assertEqual(fingerprint, pack_a2.get_resource('a.png').get_fingerprint())
+            self.assertNotEqual(fingerprint, pack_b.get_resource('a.png').get_fingerprint())
+
+    def test_zip_with_threads(self):
+        self.check_written_with_workers(workers=3)
+
+    def test_zip_with_processes(self):
+        self.check_written_with_workers(workers=2, processes=True)
+
 
 class GridMapTests(TestCase):
     def test_coords(self):
@@ -206,6 +568,10 @@ class GridMapTests(TestCase):
         with self.assertRaises(NotInMap):
             mappe.get_box('echo')
 
+    def test_repeated_name(self):
+        mappe = GridMap((32, 32), (16, 16), ['alpha', 'blank', 'charlie', 'blank'])
+        self.assertEqual((16, 0, 32, 16), mappe.get_box('blank'))
+
     def test_coords_offset(self):
         map2 = GridMap((0, 96, 32, 128), (16, 16), ['whiskey', 'x-ray', 'yankee', 'zulu'])
         self.assertEqual((0, 96, 16, 112), map2.get_box('whiskey'))
@@ -264,6 +630,16 @@ class CompositeMapTests(TestCase):
 
         self.assertEqual(set(names1) | set(names2), set(map3.names))
 
+    def test_earliest_map_wins(self):
+        map1 = GridMap((32, 16), (16, 16), ['alpha', 'bravo'])
+        map2 = GridMap((0, 16, 32, 32), (16, 16), ['bravo', 'charlie'])
+        map3 = CompositeMap([CompositeMap([map1]), map2])
+
+        self.assertEqual((16, 0, 32, 16), map3.get_box('bravo'))
+        self.assertEqual((16, 16, 32, 32), map3.get_box('charlie'))
+        with self.assertRaises(NotInMap):
+            map3.get_box('delta')
+
 
 class AtlasTests(TestCase):
     def setUp(self):
@@ -320,6 +696,442 @@ class CompositeResourceTests(TestCase):
         bytes = res.get_bytes()
         self.assert_PNGs_match(self.get_data('a_b_replace.png'), bytes)
 
+    def test_pool_gives_identical_bytes(self):
+        pack_ab = self.make_source_pack('AB', 'Has A and B', {'a.png': ('a.png', None), 'b.png': ('b.png', None)})
+        map_a = GridMap((32, 32), (16, 16), ['yellow', 'red', 'orange', 'green'])
+        map_b = GridMap((32, 32), (16, 16), ['blue', 'cyan', 'green', 'magenta'])
+        pool = ThreadPool(4)
+        try:
+            ress = []
+            for p in [None, pool]:
+                res = CompositeResource('b.png', pack_ab.get_resource('b.png'), map_b, pool=p)
+                res.replace(pack_ab.get_resource('a.png'), map_a, {'blue': 'green', 'magenta': 'yellow'})
+                res.replace(pack_ab.get_resource('a.png'), map_a, {'cyan': 'green', 'magenta': 'red'})
+                ress.append(res)
+            self.assertEqual(ress[0].get_bytes(), ress[1].get_bytes())
+        finally:
+            pool.close()
+
+    def test_paste_cells_crops_each_source_box_once(self):
+        src_im = Mock()
+        src_im.crop.return_value = Mock()
+        im = Mock()
+        paste_cells(im, [
+            (src_im, (0, 0, 16, 16), (0, 0, 16, 16)),
+            (src_im, (0, 0, 16, 16), (16, 0, 32, 16)),
+            (src_im, (16, 0, 32, 16), (0, 0, 16, 16)),
+        ])
+        self.assertEqual(2, src_im.crop.call_count)
+        # Pasted in the order given, so the last cell wins.
+        self.assertEqual([(0, 0, 16, 16), (16, 0, 32, 16), (0, 0, 16, 16)],
+                [args[1] for args, kwargs in im.paste.call_args_list])
+
+
+class ReplaceFileTests(TestCase):
+    def setUp(self):
+        super(ReplaceFileTests, self).setUp()
+        self.file_path = os.path.join(self.test_dir, 'replaced.txt')
+        self.temp_path = self.file_path + '.tmp'
+        with open(self.file_path, 'wb') as strm:
+            strm.write('old')
+
+    def test_replaces_existing_file(self):
+        with open(self.temp_path, 'wb') as strm:
+            strm.write('new')
+        replace_file(self.temp_path, self.file_path)
+
+        self.assertEqual('new', open(self.file_path, 'rb').read())
+        self.assertFalse(os.path.exists(self.temp_path))
+
+    def test_missing_temp_file_leaves_destination_alone(self):
+        if os.path.exists(self.temp_path):
+            os.remove(self.temp_path)
+        with self.assertRaises(OSError):
+            replace_file(self.temp_path, self.file_path)
+
+        self.assertEqual('old', open(self.file_path, 'rb').read())
+
+
+class RenderCacheTests(TestCase):
+    def setUp(self):
+        super(RenderCacheTests, self).setUp()
+        self.cache_dir = os.path.join(self.test_dir, 'render_cache')
+        if os.path.exists(self.cache_dir):
+            shutil.rmtree(self.cache_dir)
+        self.pack_ab = self.make_source_pack('AB', 'Has A and B', {'a.png': ('a.png', None), 'b.png': ('b.png', None)})
+        self.map_a = GridMap((32, 32), (16, 16), ['yellow', 'red', 'orange', 'green'])
+        self.map_b = GridMap((32, 32), (16, 16), ['blue', 'cyan', 'green', 'magenta'])
+
+    def make_resource(self, cache, cells):
+        res = CompositeResource('b.png', self.pack_ab.get_resource('b.png'), self.map_b, render_cache=cache)
+        res.replace(self.pack_ab.get_resource('a.png'), self.map_a, cells)
+        return res
+
+    def test_get_put(self):
+        cache = RenderCache(self.cache_dir)
+        self.assertTrue(cache.get('deadbeef') is None)
+        cache.put('deadbeef', 'bytes')
+        self.assertEqual('bytes', cache.get('deadbeef'))
+
+    def test_evicts_least_recently_used(self):
+        cache = RenderCache(self.cache_dir, max_bytes=10)
+        cache.put('one', 'aaaa')
+        cache.put('two', 'bbbb')
+        os.utime(os.path.join(self.cache_dir, 'one.png'), (1000, 1000))
+        os.utime(os.path.join(self.cache_dir, 'two.png'), (2000, 2000))
+        cache.put('three', 'cccc')
+        self.assertTrue(cache.get('one') is None)
+        self.assertEqual('bbbb', cache.get('two'))
+        self.assertEqual('cccc', cache.get('three'))
+
+    def test_tolerates_files_removed_by_another_process(self):
+        cache = RenderCache(self.cache_dir, max_bytes=10)
+        cache.put('one', 'aaaa')
+        cache.put('two', 'bbbb')
+        os.remove(os.path.join(self.cache_dir, 'one.png'))
+        cache.put('three', 'cccc')
+        cache.put('four', 'dddd')
+        self.assertEqual('dddd', cache.get('four'))
+
+    def test_composite_served_from_cache(self):
+        cache = RenderCache(self.cache_dir)
+        res1 = self.make_resource(cache, {'blue': 'green', 'magenta': 'yellow'})
+        bytes1 = res1.get_bytes()
+        self.assert_PNGs_match(self.get_data('a_b_replace.png'), bytes1)
+
+        res2 = self.make_resource(cache, {'blue': 'green', 'magenta': 'yellow'})
+        self.assertEqual(res1.get_fingerprint(), res2.get_fingerprint())
+        self.assertEqual(bytes1, res2.get_bytes())
+        self.assertTrue(res2._image is None) # Was not composited.
+
+    def test_fast_profile(self):
+        res1 = self.make_resource(None, {'blue': 'green', 'magenta': 'yellow'})
+        res2 = self.make_resource(None, {'blue': 'green', 'magenta': 'yellow'})
+        res2.encode_profile = 'fast'
+        self.assert_PNGs_match(res1.get_bytes(), res2.get_bytes())
+
+    def test_unknown_profile(self):
+        with self.assertRaises(ValueError):
+            BlankResource(encode_profile='sloppy')
+
+    def test_different_cells_different_fingerprint(self):
+        res1 = self.make_resource(None, {'blue': 'green', 'magenta': 'yellow'})
+        res2 = self.make_resource(None, {'blue': 'green', 'magenta': 'red'})
+        self.assertNotEqual(res1.get_fingerprint(), res2.get_fingerprint())
+
+    def test_render_version_in_fingerprint(self):
+        res1 = self.make_resource(None, {'blue': 'green', 'magenta': 'yellow'})
+        res2 = self.make_resource(None, {'blue': 'green', 'magenta': 'yellow'})
+        fingerprint = res1.get_fingerprint()
+        with patch('texturepacker.mixer.RENDER_VERSION', texturepacker.mixer.RENDER_VERSION + 1):
+            self.assertNotEqual(fingerprint, res2.get_fingerprint())
+
+
+class SpecCacheTests(TestCase):
+    def setUp(self):
+        super(SpecCacheTests, self).setUp()
+        self.cache_dir = os.path.join(self.test_dir, 'spec_cache')
+        if os.path.exists(self.cache_dir):
+            shutil.rmtree(self.cache_dir)
+        self.cache = SpecCache(self.cache_dir)
+
+    def test_parses_once(self):
+        text = 'terrain.png:\n  - terrain.png\n  - {names: [a, b]}\n'
+        expected = {'terrain.png': ['terrain.png', {'names': ['a', 'b']}]}
+        self.assertEqual(expected, self.cache.parse(text))
+        with patch('texturepacker.mixer.parse_spec') as mock_parse:
+            self.assertEqual(expected, SpecCache(self.cache_dir).parse(text))
+            self.assertFalse(mock_parse.called)
+
+    def test_json_and_yaml_kept_apart(self):
+        self.assertEqual([1, 2], self.cache.parse('[1, 2]', 'application/json'))
+        self.assertEqual([1, 2], self.cache.parse('[1, 2]'))
+        self.assertEqual(2, len(os.listdir(self.cache_dir)))
+
+    def test_unreadable_entry_parsed_again(self):
+        self.cache.parse('- a\n')
+        for file_name in os.listdir(self.cache_dir):
+            with open(os.path.join(self.cache_dir, file_name), 'wb') as strm:
+                strm.write('\xFF')
+        self.assertEqual(['a'], self.cache.parse('- a\n'))
+
+    def test_loader_uses_spec_cache(self):
+        file_path = os.path.join(self.test_dir, 'spec.tpmaps')
+        with open(file_path, 'wb') as strm:
+            strm.write('a.png: null\n')
+        loader = Loader(spec_cache=self.cache)
+        self.assertEqual({'a.png': None}, loader.maybe_get_spec({'file': file_path}))
+        self.assertEqual(1, len(os.listdir(self.cache_dir)))
+
+
+class HttpClientTests(TestCase):
+    def setUp(self):
+        super(HttpClientTests, self).setUp()
+        self.server = self.start_server()
+        self.server.add('/frog.zip', 'application/zip', 'frog' * 100)
+        self.server.add('/toad.zip', 'application/zip', 'toad' * 50)
+        self.client = HttpClient()
+        self.addCleanup(self.client.close)
+
+    def test_set_http_cache_applies_to_existing_client(self):
+        http1 = self.client.get_http()
+        other_dir = os.path.join(self.test_dir, 'other_cache')
+        set_http_cache(other_dir)
+        self.assertEqual(other_dir, self.client.cache)
+        http2 = self.client.get_http()
+        self.assertFalse(http1 is http2)
+        self.assertEqual(other_dir, http2.cache.cache)
+
+    def test_own_cache_overrides_default(self):
+        client = HttpClient(cache=os.path.join(self.test_dir, 'own_cache'))
+        set_http_cache(os.path.join(self.test_dir, 'other_cache'))
+        self.assertEqual(os.path.join(self.test_dir, 'own_cache'), client.cache)
+
+    def test_spooled_downloads_reuse_connection(self):
+        meta, strm = self.client.get_spooled(self.server.url('/frog.zip'), 1000)
+        self.assertEqual('frog' * 100, strm.read())
+        meta, strm = self.client.get_spooled(self.server.url('/toad.zip'), 1000)
+        self.assertEqual('toad' * 50, strm.read())
+
+        self.assertEqual(['/frog.zip', '/toad.zip'], self.server.requests)
+        self.assertEqual(self.server.clients[0], self.server.clients[1])
+
+    def test_reconnects_if_connection_dropped(self):
+        self.client.get_spooled(self.server.url('/frog.zip'), 1000)
+        for conns in self.client._connections.values():
+            for conn in conns:
+                conn.sock.close()
+
+        meta, strm = self.client.get_spooled(self.server.url('/toad.zip'), 1000)
+        self.assertEqual('toad' * 50, strm.read())
+        self.assertNotEqual(self.server.clients[0], self.server.clients[1])
+
+    def test_spooled_downloads_kept_in_cache_dir(self):
+        self.server.add('/newt.zip', 'application/zip', 'newt' * 100, etag='"newt1"')
+        cache_dir = os.path.join(self.test_dir, 'spool_cache')
+        if os.path.exists(cache_dir):
+            shutil.rmtree(cache_dir)
+        meta, strm = HttpClient(cache_dir).get_spooled(self.server.url('/newt.zip'), 1000)
+        self.assertEqual('newt' * 100, strm.read())
+        strm.close()
+
+        # Another client (in another process, say) need not download it again.
+        client = HttpClient(cache_dir)
+        meta, strm = client.get_spooled(self.server.url('/newt.zip'), 1000)
+        self.assertEqual('newt' * 100, strm.read())
+        strm.close()
+        self.assertEqual(['304'], [entry['status'] for entry in client.log])
+
+        # Until it changes.
+        self.server.add('/newt.zip', 'application/zip', 'NEWT' * 100, etag='"newt2"')
+        meta, strm = client.get_spooled(self.server.url('/newt.zip'), 1000)
+        self.assertEqual('NEWT' * 100, strm.read())
+        strm.close()
+        self.assertEqual('"newt2"', meta['etag'])
+
+    def test_log(self):
+        self.client.get_spooled(self.server.url('/frog.zip'), 1000)
+        self.client.request(self.server.url('/toad.zip'))
+
+        self.assertEqual([self.server.url('/frog.zip'), self.server.url('/toad.zip')],
+                [entry['url'] for entry in self.client.log])
+        self.assertEqual([400, 200], [entry['bytes'] for entry in self.client.log])
+        self.assertEqual(['200', '200'], [entry['status'] for entry in self.client.log])
+        self.assertTrue(all(entry['seconds'] >= 0 for entry in self.client.log))
+
+    def test_loader_shares_client_with_unwrapper(self):
+        loader = Loader()
+        self.assertTrue(loader._unwrapper.http is loader.http)
+
+
+class RangeRequestTests(TestCase):
+    def setUp(self):
+        super(RangeRequestTests, self).setUp()
+        self.server = self.start_server(accept_ranges=True)
+        self.contents = {}
+        strm = StringIO()
+        with ZipFile(strm, 'w', ZIP_STORED) as zip:
+            for name in ['a.dat', 'b.dat', 'c.dat', 'd.dat']:
+                # Hashes so the data is different throughout.
+                self.contents[name] = ''.join(hashlib.sha1(name + str(i)).digest() for i in range(5000))
+                zip.writestr(name, self.contents[name])
+        self.zip_data = strm.getvalue()
+        self.server.add('/pack.zip', 'application/zip', self.zip_data, etag='"pack1"')
+        self.client = HttpClient()
+        self.addCleanup(self.client.close)
+
+    def test_reads_only_entries_used(self):
+        loader = Loader(http=self.client)
+        meta, strm = loader.get_url_stream(self.server.url('/pack.zip'), 'zip')
+        self.assertTrue(isinstance(strm, HttpRangeFile))
+        pack = SourcePack(strm, Atlas())
+
+        self.assertEqual(sorted(self.contents), sorted(pack.get_resource_names()))
+        self.assertEqual(self.contents['b.dat'], pack.get_resource('b.dat').get_bytes())
+        self.assertEqual(2, len(self.server.requests))
+        self.assertEqual('bytes=-131072', self.server.ranges[0])
+        self.assertTrue(sum(entry['bytes'] for entry in self.client.log) < len(self.zip_data) * 3 // 4)
+
+    def test_local_extra_field_longer_than_central(self):
+        # Some ZIP tools put more in the local header’s extra field.
+        strm = StringIO()
+        with ZipFile(strm, 'w', ZIP_STORED) as zip:
+            zinfo = ZipInfo('e.dat')
+            zinfo.extra = 'UT\x09\x00\x03' + '\0' * 8 + 'ux\x0b\x00\x01\x04' + '\0' * 9
+            zip.writestr(zinfo, self.contents['a.dat'])
+            zinfo.extra = '' # Only in the local header.
+            for name in ['b.dat', 'c.dat']:
+                zip.writestr(name, self.contents[name])
+        self.server.add('/padded.zip', 'application/zip', strm.getvalue())
+        loader = Loader(http=self.client)
+        meta, strm = loader.get_url_stream(self.server.url('/padded.zip'), 'zip')
+        pack = SourcePack(strm, Atlas())
+        del self.server.requests[:]
+
+        self.assertEqual(self.contents['a.dat'], pack.get_resource('e.dat').get_bytes())
+        self.assertEqual(1, len(self.server.requests))
+
+    def test_raw_zip_entry_from_ranges(self):
+        loader = Loader(http=self.client)
+        meta, strm = loader.get_url_stream(self.server.url('/pack.zip'), 'zip')
+        pack = SourcePack(strm, Atlas())
+        local_pack = SourcePack(StringIO(self.zip_data), Atlas())
+
+        self.assertEqual(local_pack.get_resource_raw_zip_entry('a.dat'), pack.get_resource_raw_zip_entry('a.dat'))
+
+    def test_falls_back_to_download_without_ranges(self):
+        self.server.accept_ranges = False
+        loader = Loader(http=self.client)
+        meta, strm = loader.get_url_stream(self.server.url('/pack.zip'), 'zip')
+        self.assertFalse(isinstance(strm, HttpRangeFile))
+        pack = SourcePack(strm, Atlas())
+
+        self.assertEqual(self.contents['c.dat'], pack.get_resource('c.dat').get_bytes())
+        self.assertEqual(1, len(self.server.requests))
+
+    def test_not_used_if_turned_off(self):
+        loader = Loader(http=self.client, range_requests=False)
+        meta, strm = loader.get_url_stream(self.server.url('/pack.zip'), 'zip')
+        self.assertFalse(isinstance(strm, HttpRangeFile))
+        self.assertEqual([None], self.server.ranges)
+
+    def test_change_while_reading_is_noticed(self):
+        meta, strm = self.client.open_ranged(self.server.url('/pack.zip'), 1000)
+        pack = SourcePack(strm, Atlas())
+        self.server.add('/pack.zip', 'application/zip', self.zip_data[::-1], etag='"pack2"')
+
+        with self.assertRaises(CouldNotLoad):
+            pack.get_resource('a.dat').get_bytes()
+        self.assertEqual(0, self.client.log[-1]['bytes']) # Did not download the whole pack.
+
+    def test_weak_etag_not_used_in_if_range(self):
+        self.server.add('/weak.zip', 'application/zip', self.zip_data, etag='W/"pack1"')
+        meta, strm = self.client.open_ranged(self.server.url('/weak.zip'), 1000)
+        self.assertTrue(isinstance(strm, HttpRangeFile))
+        pack = SourcePack(strm, Atlas())
+
+        self.assertEqual(self.contents['a.dat'], pack.get_resource('a.dat').get_bytes())
+
+
+class LockStoreTests(TestCase):
+    def setUp(self):
+        super(LockStoreTests, self).setUp()
+        self.server = self.start_server(accept_ranges=True)
+        self.server.add('/frog.zip', 'application/zip', 'frog' * 100)
+        self.server.add('/frog.tpmaps', 'application/yaml', 'frog: {}')
+        self.store_dir = os.path.join(self.test_dir, 'lock_store')
+        if os.path.exists(self.store_dir):
+            shutil.rmtree(self.store_dir)
+        self.client = HttpClient()
+        self.addCleanup(self.client.close)
+
+    def lock(self):
+        loader = Loader(http=self.client, lock_store=LockStore(self.store_dir))
+        for path, ext in [('/frog.zip', 'zip'), ('/frog.tpmaps', 'tpmaps')]:
+            meta, strm = loader.get_url_stream(self.server.url(path), ext)
+            strm.read()
+            strm.close()
+        loader.lock_store.save()
+
+    def test_lockfile_lists_hashes(self):
+        self.lock()
+        with open(os.path.join(self.store_dir, 'lock.json'), 'rb') as strm:
+            lock = json.load(strm)
+
+        self.assertEqual({
+            self.server.url('/frog.zip'): {
+                'sha256': hashlib.sha256('frog' * 100).hexdigest(),
+                'content-type': 'application/zip',
+                'final': self.server.url('/frog.zip')},
+            self.server.url('/frog.tpmaps'): {
+                'sha256': hashlib.sha256('frog: {}').hexdigest(),
+                'content-type': 'application/yaml',
+                'final': self.server.url('/frog.tpmaps')},
+        }, lock)
+
+    def test_lockfile_records_unwrapped_url(self):
+        self.server.add('/frog.html', 'text/html', 'not a pack')
+        store = LockStore(self.store_dir)
+        loader = Loader(http=self.client, lock_store=store)
+        with patch.object(loader._unwrapper, 'unwrap', return_value={'final': self.server.url('/frog.zip')}):
+            meta, strm = loader.get_url_stream(self.server.url('/frog.html'), 'zip')
+        self.assertEqual('frog' * 100, strm.read())
+        strm.close()
+
+        self.assertEqual(self.server.url('/frog.zip'), store.lock[self.server.url('/frog.html')]['final'])
+
+    def test_lockfile_not_written_until_saved(self):
+        store = LockStore(self.store_dir)
+        store.put(self.server.url('/frog.zip'), {'content-type': 'application/zip'}, StringIO('frog' * 100))[1].close()
+
+        self.assertFalse(os.path.exists(store.lock_path))
+        store.save()
+        self.assertTrue(os.path.exists(store.lock_path))
+
+    def test_failed_download_leaves_no_temp_file(self):
+        store = LockStore(self.store_dir)
+        strm = Mock()
+        strm.read.side_effect = socket.error('connection reset')
+
+        with self.assertRaises(socket.error):
+            store.put(self.server.url('/frog.zip'), {'content-type': 'application/zip'}, strm)
+        self.assertEqual([], os.listdir(self.store_dir))
+        self.assertTrue(strm.close.called)
+
+    def test_offline_makes_no_requests(self):
+        self.lock()
+        del self.server.requests[:]
+        loader = Loader(http=self.client, lock_store=LockStore(self.store_dir, offline=True))
+        loader.prefetch([self.server.url('/frog.zip')])
+        meta, strm = loader.get_url_stream(self.server.url('/frog.zip'), 'zip')
+        self.assertEqual('frog' * 100, strm.read())
+        strm.close()
+
+        self.assertEqual({'content-type': 'application/zip'}, meta)
+        self.assertEqual([], self.server.requests)
+
+    def test_offline_checks_hash(self):
+        self.lock()
+        file_path = os.path.join(self.store_dir, hashlib.sha256('frog' * 100).hexdigest()[:2],
+                hashlib.sha256('frog' * 100).hexdigest())
+        with open(file_path, 'wb') as strm:
+            strm.write('toad' * 100)
+        loader = Loader(http=self.client, lock_store=LockStore(self.store_dir, offline=True))
+
+        with self.assertRaises(CouldNotLoad):
+            loader.get_url_stream(self.server.url('/frog.zip'), 'zip')
+
+    def test_offline_url_not_locked(self):
+        self.lock()
+        loader = Loader(http=self.client, lock_store=LockStore(self.store_dir, offline=True))
+
+        with self.assertRaises(CouldNotLoad):
+            loader.get_url_stream(self.server.url('/toad.zip'), 'zip')
+
+    def test_offline_needs_lockfile(self):
+        with self.assertRaises(CouldNotLoad):
+            LockStore(self.store_dir, offline=True)
+
 
 # Create a fake URL unwrapper.
 class StubUnwrapper(object):
@@ -431,6 +1243,30 @@ class ExternalResourceTests(TestCase):
         self.assertTrue(mock_open.call_args[0][1].startswith('r'))
 
 
+class MatchGlobsTests(unittest.TestCase):
+    names = ['terrain.png', 'gui/items.png', 'pack.txt', 'doc/news.txt', 'mob/pig.png', 'mob/[x].png']
+
+    def test_same_as_fnmatch(self):
+        patterns = ['*.png', 'mob/*', '*.txt', 'gui/*.png', '*/p?g.png', 'mob/[[]x].png', '*.gif']
+        self.assertEqual([fnmatch.filter(self.names, pattern) for pattern in patterns],
+                match_globs(patterns, self.names))
+
+    def test_no_patterns(self):
+        self.assertEqual([], match_globs([], self.names))
+
+    def test_iter_resources_keeps_order(self):
+        pack = RecipePack('Globs', 'Test')
+        for name in self.names:
+            pack.add_resource(TextResource(name, name))
+        names = [name for name in pack.get_resource_names() if name in self.names]
+        mixer = Mixer()
+        resources = mixer.iter_resources(pack, ['mob/*', 'terrain.png', '*.png', '*.txt'], None)
+
+        expected = (fnmatch.filter(names, 'mob/*') + ['terrain.png']
+            + fnmatch.filter(names, '*.png') + fnmatch.filter(names, '*.txt'))
+        self.assertEqual(expected, [res.name for res in resources])
+
+
 class ResolveUrlTests(unittest.TestCase):
     # I ended up creating my own generic URL resolver, because
     # the standard library’s urljoin seems reluctant to tackle
@@ -575,73 +1411,142 @@ class MixerTests(TestCase):
         pack2 = Mixer().get_pack('file://' + os.path.abspath(file_path))
         self.assert_same_packs(pack1, pack2)
 
-    @patch.object(texturepacker.unwrapper, 'Unwrapper', unwrapper_class_stub)
-    @patch('httplib2.Http.request')
-    def test_get_pack_from_http(self, mock_meth):
-        # Arrange that downloading any URL returns our pack.
+    def serve_sample_pack(self, path='/frog.zip'):
+        # Arrange that downloading this path returns our pack.
         pack1, data1 = self.sample_pack_and_bytes()
-        mock_meth.return_value = ({
-            'status': '200',
-            'content-type': 'application/zip',
-            'content-length': str(len(data1)),
-        }, data1)
+        server = self.start_server()
+        server.add(path, 'application/zip', data1)
+        return pack1, server
 
-        pack2 = Mixer().get_pack({'href': 'http://example.org/frog.zip'})
-        self.assertEqual('http://example.org/frog.zip', mock_meth.call_args[0][0])
+    @patch.object(texturepacker.unwrapper, 'Unwrapper', unwrapper_class_stub)
+    def test_get_pack_from_http(self):
+        pack1, server = self.serve_sample_pack()
+
+        pack2 = Mixer().get_pack({'href': server.url('/frog.zip')})
         self.assert_same_packs(pack1, pack2)
+        self.assertEqual(['/frog.zip'], server.requests)
 
     # Identical to the above except passing the URL as a string not dict.
     @patch.object(texturepacker.unwrapper, 'Unwrapper', unwrapper_class_stub)
-    @patch('httplib2.Http.request')
-    def test_get_pack_from_naked_http(self, mock_meth):
-        # Arrange that downloading any URL returns our pack.
-        pack1, data1 = self.sample_pack_and_bytes()
-        mock_meth.return_value = ({
-            'status': '200',
-            'content-type': 'application/zip',
-            'content-length': str(len(data1)),
-        }, data1)
+    def test_get_pack_from_naked_http(self):
+        pack1, server = self.serve_sample_pack()
 
-        pack2 = Mixer().get_pack('http://example.org/frog.zip')
+        pack2 = Mixer().get_pack(server.url('/frog.zip'))
         # Not laoded yet:
-        self.assertFalse(mock_meth.call_args)
+        self.assertFalse(server.requests)
 
         res = pack2.get_resource('a.png')
         # Has now downloaded the data:
-        self.assertEqual('http://example.org/frog.zip', mock_meth.call_args[0][0])
+        self.assertEqual(['/frog.zip'], server.requests)
         self.assert_same_packs(pack1, pack2)
 
 
     # Identical to the above except requires unwrapper to work.
     @patch.object(texturepacker.unwrapper, 'Unwrapper')
-    @patch('httplib2.Http.request')
-    def test_get_pack_using_unwrapper(self, request_mock, unwrapper_class_mock):
-        # Arrange that downloading any URL returns our pack.
+    def test_get_pack_using_unwrapper(self, unwrapper_class_mock):
+        pack1, server = self.serve_sample_pack('/toad.zip')
         unwrapper_mock = Mock()
         unwrapper_mock.unwrap.return_value = {
             'download': 'http://example.org/foo.bart',
-            'final': 'http://example.org/toad.zip',
+            'final': server.url('/toad.zip'),
         }
         unwrapper_class_mock.return_value  = unwrapper_mock
 
-        pack1, data1 = self.sample_pack_and_bytes()
-        request_mock.return_value = ({
-            'status': '200',
-            'content-type': 'application/zip',
-            'content-length': str(len(data1)),
-        }, data1)
-
         pack2 = Mixer().get_pack('http://parasite.ly/12345')
         # Not laoded yet:
-        self.assertFalse(request_mock.call_args)
+        self.assertFalse(server.requests)
 
         res = pack2.get_resource('a.png')
         # Has now downloaded the data:
         self.assertTrue(unwrapper_class_mock.called)
         unwrapper_mock.unwrap.assert_called_once_with('http://parasite.ly/12345')
-        self.assertEqual('http://example.org/toad.zip', request_mock.call_args[0][0])
+        self.assertEqual(['/toad.zip'], server.requests)
         self.assert_same_packs(pack1, pack2)
 
+    @patch.object(texturepacker.unwrapper, 'Unwrapper', unwrapper_class_stub)
+    def test_prefetch(self):
+        pack1, server = self.serve_sample_pack()
+        server.add('/toad.zip', 'application/zip', server.resources['/frog.zip'][1])
+        mixer = Mixer()
+        mixer.add_pack('frog', mixer.get_pack(server.url('/frog.zip')))
+        recipe = {
+            'parameters': {'packs': ['frog']},
+            'packs': {'toad': server.url('/toad.zip')},
+            'mix': {
+                'pack': '$frog',
+                'files': [{
+                    'file': 'b.png',
+                    'replace': {'pack': {'href': server.url('/newt.zip')}, 'cells': ['a']},
+                }],
+            }
+        }
+        mixer.prefetch(recipe)
+        self.assertEqual(['/frog.zip', '/newt.zip', '/toad.zip'], sorted(server.requests))
+
+        # Having been fetched, the packs are not downloaded again.
+        self.assert_same_packs(pack1, mixer.packs['frog'])
+        self.assert_same_packs(pack1, mixer.get_pack(server.url('/toad.zip')))
+        self.assertEqual(3, len(server.requests))
+
+    @patch.object(texturepacker.unwrapper, 'Unwrapper', unwrapper_class_stub)
+    def test_get_pack_from_http_spools_to_file(self):
+        pack1, server = self.serve_sample_pack()
+
+        pack2 = Mixer(loader=Loader(spool_size=100)).get_pack(server.url('/frog.zip'))
+        self.assert_same_packs(pack1, pack2)
+        self.assertTrue(pack2.get_pack().zip.fp._rolled) # Bigger than 100 bytes so went to disk.
+
+    @patch.object(texturepacker.unwrapper, 'Unwrapper', unwrapper_class_stub)
+    def test_equivalent_pack_specs_share_pack(self):
+        pack1, server = self.serve_sample_pack()
+        mixer = Mixer(prefetch_workers=0)
+
+        pack2 = mixer.get_pack(server.url('/frog.zip'))
+        pack3 = mixer.get_pack({'href': 'frog.zip'}, base=server.url('/toad.zip'))
+        self.assertTrue(pack2 is pack3)
+        pack2.get_resource('a.png').get_bytes()
+        pack3.get_resource('b.png').get_bytes()
+        self.assertEqual(['/frog.zip'], server.requests)
+
+    def test_pack_specs_with_different_maps_get_different_packs(self):
+        pack1 = self.sample_pack()
+        file_path = os.path.join(self.test_dir, 'zum.zip')
+        with open(file_path, 'wb') as strm:
+            pack1.write_to(strm)
+        mixer = Mixer()
+        base = 'file://' + os.path.join(self.test_dir, 'zip.json')
+
+        pack2 = mixer.get_pack({'file': 'zum.zip'}, base=base)
+        maps = {
+            'a.png': {
+                'source_rect': {'width': 32, 'height': 32},
+                'cell_rect': {'width': 16, 'height': 16},
+                'names': ['a', 'b'],
+            },
+        }
+        pack3 = mixer.get_pack({'file': 'zum.zip', 'maps': maps}, base=base)
+        pack4 = mixer.get_pack('zum.zip', base=base)
+        self.assertFalse(pack2 is pack3)
+        self.assertTrue(pack2 is pack4)
+
+    def test_make_unjumbled_pack_uses_first_match_once(self):
+        dir_path = os.path.join(self.test_dir, 'jumbled')
+        if os.path.exists(dir_path):
+            shutil.rmtree(dir_path)
+        for name in ['a/terrain.png', 'b/terrain.png', 'items.png', 'c/sign.png', 'pack.txt']:
+            file_path = os.path.join(dir_path, *name.split('/'))
+            if not os.path.exists(os.path.dirname(file_path)):
+                os.makedirs(os.path.dirname(file_path))
+            with open(file_path, 'wb') as strm:
+                strm.write('Jumbled\nTest pack\n' if name == 'pack.txt' else name)
+        atlas = Atlas({'terrain.png': None, 'gui/items.png': None, 'item/sign.png': None, 'item/door.png': None})
+
+        pack = Mixer().make_unjumbled_pack(SourcePack(dir_path, Atlas()), atlas)
+        self.assertEqual('a/terrain.png', pack.get_resource('terrain.png').get_bytes())
+        self.assertEqual('items.png', pack.get_resource('gui/items.png').get_bytes())
+        self.assertEqual('c/sign.png', pack.get_resource('item/sign.png').get_bytes())
+        self.assertRaises(NotInPack, pack.get_resource, 'item/door.png')
+
     def test_get_pack_from_relative_file(self):
         pack1 = self.sample_pack()
         file_path = os.path.join(self.test_dir, 'zum.zip')
@@ -660,16 +1565,13 @@ class MixerTests(TestCase):
                 base='file://' + os.path.join(self.test_dir, 'zip.json'))
         self.assert_same_packs(pack1, pack2)
 
-    @patch('httplib2.Http.request')
-    def test_get_pack_from_http(self, mock_meth):
+    @patch.object(texturepacker.unwrapper, 'Unwrapper', unwrapper_class_stub)
+    def test_get_pack_from_http(self):
         # Arrange that downloading any URL fails.
-        pack1, data1 = self.sample_pack_and_bytes()
-        mock_meth.return_value = ({
-            'status': '404',
-        }, 'Not found')
+        server = self.start_server()
 
         with self.assertRaises(CouldNotLoad):
-            pack2 = Mixer().get_pack({'href': 'http://example.org/frog.zip'})
+            pack2 = Mixer().get_pack({'href': server.url('/frog.zip')})
 
             # Force it to be loaded:
             res = pack2.get_resource('a.png')
@@ -1467,6 +2369,45 @@ class TestLastModified(TestCase):
         self.check_modified_since(res_b)
         self.check_modified_since(pack)
 
+    def test_modified_since_reads_no_contents(self):
+        simple_map = GridMap((32, 32), (16, 16), ['a', 'b', 'c', 'd'])
+        file_path = os.path.join(self.test_dir, 'meta.zip')
+        with open(file_path, 'wb') as strm:
+            self.write_pack_contents(strm,'AB', 'Has A and B',
+                    {'a.png': ('a.png', simple_map)})
+        pack = SourcePack(file_path, Atlas())
+        then = pack.get_last_modified()
+
+        with patch.object(ZipFile, 'read') as mock_read:
+            with patch.object(ZipFile, 'open') as mock_open:
+                self.assertFalse(pack.is_modified_since(then))
+                self.assertTrue(pack.is_modified_since(then - timedelta(seconds=2)))
+
+                mixer = Mixer()
+                mixer.add_pack('ab', pack)
+                recipe_pack = mixer.make({
+                    'label': 'AB2',
+                    'desc': 'Copy of AB',
+                    'parameters': {'packs': ['ab']},
+                    'mix': {
+                        'pack': '$ab',
+                        'files': ['*.txt', 'a.png', {'file': 'b.png', 'source': 'a.png'}],
+                    },
+                })
+                self.assertFalse(recipe_pack.is_modified_since(then))
+                self.assertTrue(recipe_pack.is_modified_since(then - timedelta(seconds=2)))
+        self.assertFalse(mock_read.called)
+        self.assertFalse(mock_open.called)
+
+    def test_source_text_resource_read_lazily(self):
+        pack = self.make_source_pack('Sign pack', 'Just a test', {'item/sign.png': ('sign.png', None)})
+        with patch.object(SourcePack, 'get_resource_bytes') as mock_get_bytes:
+            mock_get_bytes.return_value = 'Sign pack\nJust a test\n'
+            res = pack.get_resource('pack.txt')
+            self.assertFalse(mock_get_bytes.called)
+            self.assertEqual(u'Sign pack\nJust a test\n', res.get_content())
+            self.assertEqual(1, mock_get_bytes.call_count)
+
     def test_composite_resource(self):
         # Create 2 resources
         simple_map = GridMap((32, 32), (16, 16), ['a', 'b', 'c', 'd'])
@@ -1732,6 +2673,36 @@ class TestMixerGetAtlas(TestCase):
         atlas = mixer.get_atlas('http://example.com/mapmap/mapittymap.tpmaps', 'http://example.com/zuer/')
         self.assertEqual('http://example.com/mapmap/mapittymap.tpmaps', mock_request.call_args[0][0])
 
+    @patch('httplib2.Http.request')
+    def test_atlas_is_memoized(self, mock_request):
+        data = '{"terrain.png": null}'
+        mock_request.return_value = ({
+            'status': '200',
+            'content-type': 'application/json',
+            'content-length': str(len(data)),
+        }, data)
+
+        mixer = Mixer()
+        atlas1 = mixer.get_atlas('http://example.com/mapmap/mapittymap.tpmaps', 'http://example.com/zuer/')
+        atlas2 = mixer.get_atlas({'href': '../mapmap/mapittymap.tpmaps'}, 'http://example.com/zuer/')
+        self.assertTrue(atlas1 is atlas2)
+        self.assertEqual(1, mock_request.call_count)
+
+    def test_chain_of_atlases_built_once(self):
+        maps_dir = os.path.join(os.path.dirname(self.data_dir), '..', 'examples', 'maps')
+        base = 'file://' + os.path.abspath(maps_dir) + '/'
+        mixer = Mixer()
+        atlas18 = mixer.get_atlas('beta-18.tpmaps', base)
+        atlas17 = mixer.get_atlas({'file': 'beta-17.tpmaps'}, base)
+
+        self.assertTrue(atlas17 is mixer.get_atlas('beta-17.tpmaps', base))
+        redefined = ['terrain.png', 'gui/items.png'] # Extended by beta-18.
+        for name in atlas17.get_map_names():
+            if name not in redefined:
+                self.assertTrue(atlas17.get_map(name, base) is atlas18.get_map(name, base))
+        for name in redefined:
+            self.assertFalse(atlas17.get_map(name, base) is atlas18.get_map(name, base))
+
 
 class TestDepaletizationOfPaletizedImages(TestCase):
     def test_red_green(self):
@@ -1772,6 +2743,176 @@ class TestDepaletizationOfPaletizedImages(TestCase):
 
         self.assert_PNGs_match(self.get_data('redgreen.png'), remix.get_resource('redgreen.png'))
 
+    def test_paletted_sources_sharing_palette_stay_paletted(self):
+        rb_map = GridMap((32, 32), (16, 16), ['black', 'grey', 'red', 'pink'])
+        source = self.make_source_pack('Dyes', 'Dyes', {
+            'redblack.png': ('redblack.png', rb_map)})
+        self.assertEqual('P', source.get_resource_image('redblack.png').mode)
+        res = CompositeResource('redblack.png', source.get_resource('redblack.png'), rb_map)
+        res.replace(source.get_resource('redblack.png'), rb_map, {'black': 'red'})
+
+        im = res.get_image()
+        self.assertEqual('P', im.mode)
+        expected = Image.open(StringIO(self.get_data('redblack.png'))).convert('RGBA')
+        expected.paste(expected.crop((0, 16, 16, 32)), (0, 0))
+        self.assert_PNGs_match(self.get_png_bytes(expected), res.get_bytes())
+
+    def test_mixed_palettes_composited_in_rgba_and_saved_paletted(self):
+        rb_map = GridMap((32, 32), (16, 16), ['black', 'grey', 'red', 'pink'])
+        gy_map = GridMap((32, 32), (16, 16), ['green', 'lime', 'brown', 'yellow'])
+        source = self.make_source_pack('Dyes', 'Dyes', {
+            'redblack.png': ('redblack.png', rb_map),
+            'greenyellow.png': ('greenyellow.png', gy_map)})
+        res = CompositeResource('redblack.png', source.get_resource('redblack.png'), rb_map)
+        res.replace(source.get_resource('greenyellow.png'), gy_map, {'black': 'green'})
+
+        self.assertEqual('RGBA', res.get_image().mode)
+        self.assertEqual('P', Image.open(StringIO(res.get_bytes())).mode)
+        self.assert_PNGs_match(self.get_png_bytes(res.get_image()), res.get_bytes())
+
+    def get_png_bytes(self, im):
+        strm = StringIO()
+        im.save(strm, 'PNG')
+        return strm.getvalue()
+
+
+class FitPaletteTests(unittest.TestCase):
+    def test_few_colours_become_paletted(self):
+        im = Image.new('RGBA', (4, 4), (255, 255, 255, 0))
+        im.paste((255, 0, 0, 255), (0, 0, 2, 2))
+        im.paste((0, 0, 255, 255), (2, 2, 4, 4))
+
+        result = fit_palette(im)
+        self.assertEqual('P', result.mode)
+        self.assertEqual(0, result.info['transparency'])
+        strm = StringIO()
+        result.save(strm, 'PNG', transparency=result.info['transparency'])
+        reloaded = Image.open(StringIO(strm.getvalue())).convert('RGBA')
+        self.assertEqual(list(im.getdata()), list(reloaded.getdata()))
+
+    def test_partial_transparency_stays_rgba(self):
+        im = Image.new('RGBA', (4, 4), (255, 0, 0, 128))
+        self.assertTrue(fit_palette(im) is im)
+
+    def test_two_transparent_colours_stay_rgba(self):
+        im = Image.new('RGBA', (4, 4), (255, 255, 255, 0))
+        im.paste((0, 0, 0, 0), (0, 0, 2, 2))
+        self.assertTrue(fit_palette(im) is im)
+
+    def test_too_many_colours_stay_rgba(self):
+        im = Image.new('RGB', (32, 32))
+        im.putdata([(i % 256, i // 256, 0) for i in range(1024)])
+        self.assertTrue(fit_palette(im) is im)
+
+
+class MaketextureTests(TestCase):
+    def setUp(self):
+        super(MaketextureTests, self).setUp()
+        script_path = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'script', 'maketexture')
+        self.maketexture = imp.load_source('maketexture', script_path)
+        self.work_dir = tempfile.mkdtemp(dir=self.test_dir)
+        self.addCleanup(shutil.rmtree, self.work_dir, True)
+        with open(os.path.join(self.work_dir, 'xa.zip'), 'wb') as strm:
+            self.write_pack_contents(strm, 'aa', 'aaaa', {'a.png': ('a.png', None), 'b.png': ('b.png', None)})
+        self.recipes = [
+            self.write_recipe('one.json', 'xa.zip', 'a.png'),
+            self.write_recipe('broken.json', 'missing.zip', 'a.png'),
+            self.write_recipe('two.json', 'xa.zip', 'b.png'),
+        ]
+
+    def write_recipe(self, file_name, pack_file, source):
+        recipe_file = os.path.join(self.work_dir, file_name)
+        with open(recipe_file, 'wb') as strm:
+            json.dump({
+                'label': file_name,
+                'desc': 'made from ' + pack_file,
+                'packs': {'aa': {'file': pack_file}},
+                'mix': {'pack': '$aa', 'files': [{'file': 'out.png', 'source': source}]},
+            }, strm)
+        return recipe_file
+
+    def run_maketexture(self, out_dir, *args):
+        os.mkdir(out_dir)
+        stderr = StringIO()
+        with patch.object(sys, 'stderr', stderr):
+            result = self.maketexture.main(['maketexture', '--output', out_dir] + list(args))
+        return result, stderr.getvalue()
+
+    def get_zip_contents(self, file_path):
+        with ZipFile(file_path) as zip:
+            return dict((name, zip.read(name)) for name in zip.namelist())
+
+    def test_failure_does_not_stop_other_recipes(self):
+        out_dir = os.path.join(self.work_dir, 'jobs')
+        result, messages = self.run_maketexture(out_dir, '--jobs=2', *self.recipes)
+
+        self.assertEqual(1, result)
+        self.assertEqual(['one.zip', 'one.zip.tpmanifest', 'two.zip', 'two.zip.tpmanifest'],
+                sorted(os.listdir(out_dir)))
+        self.assertTrue('{0}: failed: '.format(self.recipes[1]) in messages)
+        self.assertTrue('missing.zip' in messages)
+        self.assertTrue('1 of 3 recipes failed' in messages)
+        self.assertFalse(self.recipes[0] + ': failed' in messages)
+        self.assertFalse(self.recipes[2] + ': failed' in messages)
+
+    def test_same_output_as_serial_build(self):
+        good_recipes = [self.recipes[0], self.recipes[2]]
+        jobs_dir = os.path.join(self.work_dir, 'jobs')
+        serial_dir = os.path.join(self.work_dir, 'serial')
+        self.run_maketexture(jobs_dir, '--jobs=2', *good_recipes)
+        self.run_maketexture(serial_dir, *good_recipes)
+
+        for name in ['one.zip', 'two.zip']:
+            self.assertEqual(self.get_zip_contents(os.path.join(serial_dir, name)),
+                    self.get_zip_contents(os.path.join(jobs_dir, name)))
+        self.assertNotEqual(self.get_zip_contents(os.path.join(jobs_dir, 'one.zip'))['out.png'],
+                self.get_zip_contents(os.path.join(jobs_dir, 'two.zip'))['out.png'])
+
+
+    def test_bad_settings_reported_before_starting_workers(self):
+        out_dir = os.path.join(self.work_dir, 'jobs')
+        store_dir = os.path.join(self.work_dir, 'no_store')
+        result, messages = self.run_maketexture(out_dir, '--offline', '--store', store_dir, '--jobs=2',
+                self.recipes[0], self.recipes[2])
+
+        self.assertEqual(2, result)
+        self.assertTrue('--offline: ' in messages)
+        self.assertEqual([], os.listdir(out_dir))
+
+    def test_worker_that_cannot_start_fails_each_task(self):
+        with patch.object(self.maketexture, 'make_mixer', side_effect=CouldNotLoad('no mixer for you')):
+            self.maketexture._init_worker({'verbose': 0})
+        results = [self.maketexture._build_in_worker((recipe_file, recipe_file + '.zip'))
+                for recipe_file in [self.recipes[0], self.recipes[2]]]
+
+        self.assertEqual([
+            (self.recipes[0], 'CouldNotLoad: no mixer for you', []),
+            (self.recipes[2], 'CouldNotLoad: no mixer for you', []),
+        ], results)
+
+    def test_failed_manifest_does_not_leave_old_one(self):
+        out_dir = os.path.join(self.work_dir, 'serial')
+        self.run_maketexture(out_dir, self.recipes[0])
+        manifest_file = os.path.join(out_dir, 'one.zip.tpmanifest')
+        self.assertTrue(os.path.exists(manifest_file))
+
+        self.write_recipe('one.json', 'xa.zip', 'b.png')
+        with patch.object(self.maketexture.json, 'dump', side_effect=IOError('disc full')):
+            with self.assertRaises(IOError):
+                self.maketexture.main(['maketexture', '--force', '--output', out_dir, self.recipes[0]])
+
+        self.assertFalse(os.path.exists(manifest_file))
+        self.assertEqual(self.get_data('b.png'), self.get_zip_contents(os.path.join(out_dir, 'one.zip'))['out.png'])
+        self.assertEqual(['one.zip'], os.listdir(out_dir))
+
+    def test_failed_write_leaves_no_temp_file(self):
+        out_dir = os.path.join(self.work_dir, 'serial')
+        with patch('texturepacker.mixer.write_zip_entry', side_effect=IOError('disc full')):
+            with self.assertRaises(IOError):
+                self.run_maketexture(out_dir, self.recipes[0])
+
+        self.assertEqual([], os.listdir(out_dir))
+
 
 if __name__ == '__main__':
     unittest.main()
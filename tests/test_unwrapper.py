@@ -13,6 +13,9 @@ import sys
 import os
 import httplib2
 import json
+import tempfile
+import shutil
+import threading
 from texturepacker.unwrapper import *
 
 # First some helper functions for faking the HTTP requests the tests involve …
@@ -226,6 +229,34 @@ class TestGuessUrls(unittest.TestCase):
         self.assertTrue(guess_url_is_home('http://www.planetminecraft.com/texture_pack/leostereos-textures-revamped/'))
 
 
+# Tests for finding the parts of pages unwrappers need without parsing the whole page.
+
+class TestScanning(unittest.TestCase):
+    def test_scan_element_includes_nested_elements(self):
+        body = ('<div class="top"><div class="post entry-content"><div>1</div>2</div>'
+                '<div class="entry-content">3</div></div>')
+        self.assertEqual('<div class="post entry-content"><div>1</div>2</div>',
+                scan_element(body, 'div', 'entry-content'))
+
+    def test_scan_element_matches_whole_class_names(self):
+        self.assertEqual(None, scan_element('<div class="entry-contented">1</div>', 'div', 'entry-content'))
+
+    def test_scan_element_unclosed(self):
+        self.assertEqual(None, scan_element('<div class="entry-content"><div>1</div>', 'div', 'entry-content'))
+
+    def test_scan_mediafire_scripts_agrees_with_soup(self):
+        body = get_data('mediafire.html')
+        self.assertEqual(soup_mediafire_scripts(body), scan_mediafire_scripts(body))
+
+    def test_falls_back_to_parsing_whole_page(self):
+        # Unquoted class attributes are not recognized by scan_element.
+        body = ('<html><body><div class=entry-content><a class="bbc_url" '
+                'href="http://www.mediafire.com/?frog">Download</a></div></body></html>')
+        self.assertEqual(None, scan_element(body, 'div', 'entry-content'))
+        urls = unwrap_minecraftforum('http://www.minecraftforum.net/topic/1-frog/', {}, body)
+        self.assertEqual('http://www.mediafire.com/?frog', urls['next'])
+
+
 # Test for taking a URL through several hops to its final source.
 class TestUnwrapper(unittest.TestCase):
     @stub_http(('http://adf.ly/380075/forestdepths', 'adfly'), ('http://bit.ly/pXTHAp', 'forum1'), ('http://www.mediafire.com/?p6gbi987u93t6os', 'mediafire'), ('http://www.mediafire.com/dynamic/download.php?qk=p6gbi987u93t6os&pk1=f8cff2a113114097978837db48750c2f0dbe1ae019c327dd15760ee74e3cb0aa93ed8fc77d41bccfedcc9f367b3597dc&r=3p0y3', 'mediafire-download-2'))
@@ -296,6 +327,125 @@ class TestPlanetMinecraftDownload(unittest.TestCase):
         self.assertEqual(False, follow_redirects)
 
 
+FOREST_DEPTHS_STUBS = [
+    ('http://adf.ly/380075/forestdepths', 'adfly'),
+    ('http://bit.ly/pXTHAp', 'forum1'),
+    ('http://www.mediafire.com/?p6gbi987u93t6os', 'mediafire'),
+    ('http://www.mediafire.com/dynamic/download.php?qk=p6gbi987u93t6os&pk1=f8cff2a113114097978837db48750c2f0dbe1ae019c327dd15760ee74e3cb0aa93ed8fc77d41bccfedcc9f367b3597dc&r=3p0y3', 'mediafire-download-2'),
+]
+
+# Test for remembering where URLs lead between runs.
+class TestUnwrapCache(unittest.TestCase):
+    @stub_http(*FOREST_DEPTHS_STUBS)
+    def setUp(self, http):
+        self.dir_path = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.dir_path)
+        self.http = http
+        self.http.requests = []
+        self.urls1 = Unwrapper(cache=UnwrapCache(self.dir_path)).unwrap('http://adf.ly/380075/forestdepths')
+        self.count1 = len(self.http.requests)
+        self.urls2 = Unwrapper(cache=UnwrapCache(self.dir_path)).unwrap('http://adf.ly/380075/forestdepths')
+        self.count2 = len(self.http.requests)
+        Unwrapper(cache=UnwrapCache(self.dir_path, refresh=True)).unwrap('http://adf.ly/380075/forestdepths')
+        self.count3 = len(self.http.requests)
+        Unwrapper(cache=UnwrapCache(self.dir_path)).unwrap('http://adf.ly/380075/forestdepths', refresh=True)
+        self.count4 = len(self.http.requests)
+        Unwrapper(cache=UnwrapCache(self.dir_path, ttl=-1)).unwrap('http://adf.ly/380075/forestdepths')
+        self.count5 = len(self.http.requests)
+
+    def test_second_unwrap_makes_no_requests(self):
+        self.assertEqual(4, self.count1)
+        self.assertEqual(4, self.count2)
+
+    def test_same_result(self):
+        self.assertEqual(self.urls1, self.urls2)
+        self.assertTrue(isinstance(self.urls2['final'], str))
+
+    def test_refresh(self):
+        self.assertEqual(8, self.count3)
+        self.assertEqual(12, self.count4)
+
+    def test_expired(self):
+        self.assertEqual(16, self.count5)
+
+
+# Test that unwrapping only some of the way is not remembered.
+class TestPartialUnwrapCache(unittest.TestCase):
+    @stub_http(*FOREST_DEPTHS_STUBS)
+    def setUp(self, http):
+        self.dir_path = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.dir_path)
+        self.http = http
+        self.http.requests = []
+        unwrapper = Unwrapper(cache=UnwrapCache(self.dir_path))
+        unwrapper.unwrap('http://adf.ly/380075/forestdepths', until=['download', 'forum'])
+        self.urls = unwrapper.unwrap('http://adf.ly/380075/forestdepths')
+
+    def test_unwrapped_again(self):
+        self.assertEqual(['adfly', 'forum1', 'adfly', 'forum1', 'mediafire', 'mediafire-download-2'],
+                [x for (x, y, z) in self.http.requests])
+
+    def test_found_final_url(self):
+        self.assertTrue('final' in self.urls)
+
+class SlowHttp(object):
+    """Pretends bit.ly links lead straight to ZIP files, taking a while to say so.
+
+    Each request waits (for up to timeout seconds) until expected_active
+    requests are in progress to the same host, so that the test does not
+    depend on how quickly the threads happen to start.
+    Also records the most requests made to any one host at once.
+    """
+    def __init__(self, expected_active, timeout=5):
+        self.expected_active = expected_active
+        self.timeout = timeout
+        self.requests = []
+        self.active = {}
+        self.max_active = 0
+        self.lock = threading.Lock()
+        self.all_active = threading.Event()
+
+    def request(self, url, *args, **kwargs):
+        host = url.split('/')[2]
+        with self.lock:
+            self.requests.append(url)
+            self.active[host] = self.active.get(host, 0) + 1
+            self.max_active = max(self.max_active, self.active[host])
+            if self.active[host] >= self.expected_active:
+                self.all_active.set()
+        self.all_active.wait(self.timeout)
+        with self.lock:
+            self.active[host] -= 1
+        if url.endswith('/broken'):
+            raise httplib2.HttpLib2Error('Broken!')
+        return {'status': '200', 'content-location': url.replace('bit.ly', 'example.com') + '.zip'}, ''
+
+
+# Tests for unwrapping many URLs at once.
+class TestUnwrapMany(unittest.TestCase):
+    def setUp(self):
+        self.http = SlowHttp(expected_active=3)
+        self.unwrapper = Unwrapper(self.http)
+        self.urls = ['http://bit.ly/{0}'.format(i) for i in range(8)]
+        self.results = list(self.unwrapper.unwrap_many(self.urls + ['http://bit.ly/broken', 'http://bit.ly/0'],
+                workers=8, per_host=3))
+
+    def test_all_unwrapped_once(self):
+        self.assertEqual(sorted(self.urls + ['http://bit.ly/broken']), sorted(self.http.requests))
+        self.assertEqual(sorted(self.urls + ['http://bit.ly/broken']), sorted(url for url, result in self.results))
+
+    def test_results(self):
+        results = dict(self.results)
+        self.assertEqual({'final': 'http://example.com/3.zip'}, results['http://bit.ly/3'])
+
+    def test_error_returned(self):
+        self.assertTrue(isinstance(dict(self.results)['http://bit.ly/broken'], httplib2.HttpLib2Error))
+
+    def test_concurrent_but_limited_per_host(self):
+        self.assertTrue(self.http.all_active.is_set(), 'never had 3 requests in progress at once')
+        self.assertTrue(self.http.max_active <= 3, '{0} requests in progress at once'.format(self.http.max_active))
+
+
 if __name__ == '__main__':
     sys.exit(unittest.main())
 